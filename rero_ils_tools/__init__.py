@@ -20,81 +20,117 @@
 
 import click
 from flask.cli import FlaskGroup
-from invenio_app.factory import create_app
 
-from .cli.delete.bibliomedia import bibliomedia
-from .cli.desherbage.vs import vs
-from .cli.example import app
-from .cli.items.replace import items_replace
-from .cli.items.update import items_update
-from .cli.migration.clean_templates import clean_templates
-from .cli.patrons.duplicate_emails import duplicate_emails
-from .cli.patrons.fix_patron_emails import fix_patron_emails
-from .cli.patrons.validate_checkouts import validate_checkouts
-from .cli.query.query import records_query
-from .cli.update.circ_category import set_circulation_category
+from .cli.lazy import LazyGroup
 
 
-@click.group(cls=FlaskGroup, create_app=create_app)
-def tools_cli():
-    """All app commands."""
+def create_app(**kwargs):
+    """Create the application, invenio is imported only when needed."""
+    from invenio_app.factory import create_app as invenio_create_app
+    return invenio_create_app(**kwargs)
 
 
-@tools_cli.group()
-def tools():
+@click.group(cls=FlaskGroup, create_app=create_app)
+@click.option('--cprofile', 'cprofile', default=None,
+              help='Profile the command with cProfile to the given file.')
+@click.option('--sample', 'sample', default=None,
+              help='Write sampled stacks in folded format to the given file.')
+@click.option('--sample-interval', 'sample_interval', type=float,
+              default=0.01, help='Stacks sampling interval in seconds.')
+@click.pass_context
+def tools_cli(ctx, cprofile, sample, sample_interval):
+    """All app commands."""
+    if cprofile or sample:
+        from .instrumentation import StackSampler, start_cprofile
+        if cprofile:
+            ctx.call_on_close(start_cprofile(cprofile))
+        if sample:
+            sampler = StackSampler(sample, sample_interval)
+            sampler.start()
+            ctx.call_on_close(sampler.stop)
+
+
+@tools_cli.group(cls=LazyGroup, lazy_subcommands={
+    'app': ('.cli.example:app', 'This script returns a simple flask app.')
+})
+@click.option('--profile', 'profile', is_flag=True, default=False,
+              help='Print the time of the phases, SQL and ES requests.')
+@click.option('--profile-output', 'profile_output', default=None,
+              help='Write the profile summary to a JSON file.')
+@click.pass_context
+def tools(ctx, profile, profile_output):
     """Tools commands."""
-
-
-@tools.group()
+    if profile or profile_output:
+        from .instrumentation import start_profiler, stop_profiler
+        start_profiler()
+        ctx.call_on_close(lambda: stop_profiler(profile_output))
+
+
+@tools.group(cls=LazyGroup, lazy_subcommands={
+    'set_circulation_category': (
+        '.cli.update.circ_category:set_circulation_category',
+        'Set circulation category for items.'),
+    'items': ('.cli.items.update:items_update', 'Update item records.')
+})
 def update():
     """Update commands."""
 
 
-@tools.group()
+@tools.group(cls=LazyGroup, lazy_subcommands={
+    'items': ('.cli.items.replace:items_replace', 'Replace item records.')
+})
 def replace():
     """Replace commands."""
 
 
-@tools.group()
+@tools.group(cls=LazyGroup, lazy_subcommands={
+    'query': ('.cli.query.query:records_query', 'Query records.')
+})
 def search():
     """Search commands."""
 
 
-@tools.group()
+@tools.group(cls=LazyGroup, lazy_subcommands={
+    'duplicate_emails': (
+        '.cli.patrons.duplicate_emails:duplicate_emails',
+        'Identify duplicate emails in patron records.'),
+    'fix_patron_emails': (
+        '.cli.patrons.fix_patron_emails:fix_patron_emails',
+        'Identify and fix patron emails.'),
+    'validate_checkouts': (
+        '.cli.patrons.validate_checkouts:validate_checkouts',
+        'Valide Virtua checkouts.'),
+    'reconcile_checkouts': (
+        '.cli.patrons.reconcile_checkouts:reconcile_checkouts',
+        'Reconcile items status with active loans of an organisation.')
+})
 def patrons():
     """Patrons commands."""
 
 
-@tools.group()
+@tools.group(cls=LazyGroup, lazy_subcommands={
+    'bibliomedia': (
+        '.cli.delete.bibliomedia:bibliomedia',
+        'Delete bibliomedia collection.')
+})
 def delete():
     """Delete commands."""
 
 
-@tools.group()
+@tools.group(cls=LazyGroup, lazy_subcommands={
+    'clean_templates': (
+        '.cli.migration.clean_templates:clean_templates',
+        'Remove from templates unwanted fields in the data dictionary.')
+})
 def migration():
     """Migration commands."""
 
 
-@tools.group()
+@tools.group(cls=LazyGroup, lazy_subcommands={
+    'vs': ('.cli.desherbage.vs:vs', 'Delete library items.'),
+    'vs_campaign': (
+        '.cli.desherbage.campaign:vs_campaign',
+        'Delete items of several libraries in parallel.')
+})
 def desherbage():
     """Desherbage commands."""
-
-
-tools.add_command(app)
-
-migration.add_command(clean_templates)
-update.add_command(set_circulation_category)
-update.add_command(items_update)
-
-replace.add_command(items_replace)
-
-search.add_command(records_query)
-
-patrons.add_command(duplicate_emails)
-patrons.add_command(fix_patron_emails)
-patrons.add_command(validate_checkouts)
-
-delete.add_command(bibliomedia)
-
-desherbage.add_command(vs)
-
@@ -16,10 +16,524 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-"""Example class."""
+"""RERO ILS Tools API."""
+
+from elasticsearch.helpers import bulk
+from elasticsearch_dsl import Q
+from flask import current_app
+from invenio_db import db
+from invenio_pidstore.models import PersistentIdentifier, PIDStatus
+from invenio_search import current_search_client
+from invenio_search.utils import build_alias_name
+from rero_ils.modules.acquisition.acq_order_lines.api import \
+    AcqOrderLinesSearch
+from rero_ils.modules.collections.api import CollectionsSearch
+from rero_ils.modules.documents.api import DocumentsSearch
+from rero_ils.modules.holdings.api import HoldingsSearch
+from rero_ils.modules.items.api import Item, ItemsSearch
+from rero_ils.modules.loans.api import LoansSearch
+from rero_ils.modules.loans.models import LoanState
+from rero_ils.modules.local_fields.api import LocalField, LocalFieldsSearch
+from rero_ils.modules.patron_transactions.api import PatronTransactionsSearch
+
+from .indexing import BulkRejected, indexing_controller, rejected_errors
+from .instrumentation import phase
+from .utils import chunks
+
+# number of values per terms query
+TERMS_SIZE = 1000
+
+# indexed fields of the links between documents
+DOCUMENT_RELATION_FIELDS = [
+    'partOf.document.pid', 'supplement.pid', 'supplementTo.pid',
+    'otherEdition.pid', 'otherPhysicalFormat.pid', 'issuedWith.pid',
+    'precededBy.pid', 'succeededBy.pid', 'relatedTo.pid',
+    'hasReproduction.pid', 'reproductionOf.pid'
+]
+
 
 class Example:
 
     @classmethod
     def example(cls):
         return 'called example'
+
+
+def _load_by_pids(record_class, pids):
+    """Load records by pid with one database query.
+
+    :param record_class: class of the records.
+    :param pids: list of pids.
+    :returns: dictionary of records by pid.
+    """
+    query = PersistentIdentifier.query.filter(
+        PersistentIdentifier.pid_type == record_class.provider.pid_type,
+        PersistentIdentifier.pid_value.in_(pids),
+        PersistentIdentifier.status == PIDStatus.REGISTERED
+    )
+    pid_by_id = {
+        identifier.object_uuid: identifier.pid_value
+        for identifier in query
+    }
+    if not pid_by_id:
+        return {}
+    return {
+        pid_by_id[record.id]: record
+        for record in record_class.get_records(list(pid_by_id))
+    }
+
+
+def fetch_many(record_class, values, chunk_size=TERMS_SIZE, key=None,
+               cache=None):
+    """Stream records by pid with one database query per chunk.
+
+    The records are returned in the order of the given values.
+
+    :param record_class: class of the records.
+    :param values: iterable of pids, or of any values if `key` is given.
+    :param chunk_size: number of pids per query.
+    :param key: function returning the pid of a value.
+    :param cache: dictionary of records by pid used and filled across
+                  calls, for records fetched several times.
+    :returns: generator of (value, record), the record is None for unknown
+              or deleted pids.
+    """
+    for chunk in chunks(values, chunk_size):
+        pids = [key(value) for value in chunk] if key else chunk
+        to_load = {pid for pid in pids if pid}
+        if cache is not None:
+            to_load -= cache.keys()
+        with phase('fetch'):
+            records = _load_by_pids(record_class, list(to_load)) \
+                if to_load else {}
+        if cache is not None:
+            cache.update(records)
+            records = cache
+        for value, pid in zip(chunk, pids):
+            yield value, records.get(pid)
+
+
+def get_records_by_pids(record_class, pids, size=TERMS_SIZE):
+    """Get records by pid with one database query per chunk.
+
+    :param record_class: class of the records.
+    :param pids: iterable of pids.
+    :param size: number of pids per query.
+    :returns: dictionary of records by pid, unknown or deleted pids are
+              missing.
+    """
+    return {
+        pid: record
+        for pid, record in fetch_many(record_class, pids, size)
+        if record
+    }
+
+
+def search_pids(search, field='pid', preserve_order=False):
+    """Stream the pids of the hits of a search.
+
+    :param search: search to scan.
+    :param field: field containing the pid.
+    :param preserve_order: keep the sort order of the search.
+    :returns: generator of pids.
+    """
+    search = search.source([field])
+    if preserve_order:
+        search = search.params(preserve_order=True)
+    for hit in search.scan():
+        yield hit[field]
+
+
+def fetch_by_field(record_class, search, chunk_size=TERMS_SIZE, **field):
+    """Stream records by the values of an indexed field.
+
+    One search and one database query are done per chunk of values. The
+    field must be a top level field with unique values, i.e. barcode.
+
+    :param record_class: class of the records.
+    :param search: search to restrict, i.e. to an organisation.
+    :param chunk_size: number of values per query.
+    :param field: field name with the iterable of values.
+    :returns: generator of (value, record) in the order of the given
+              values, the record is None for unknown values.
+    """
+    [(name, values)] = field.items()
+    for chunk in chunks(values, chunk_size):
+        query = search \
+            .filter('terms', **{name: list(set(chunk))}) \
+            .source(['pid'])
+        ids = [hit.meta.id for hit in query.scan()]
+        records = {
+            record.get(name): record
+            for record in record_class.get_records(ids)
+        } if ids else {}
+        for value in chunk:
+            yield value, records.get(value)
+
+
+def get_local_fields_by_document(document_pids, org_pid=None,
+                                 size=TERMS_SIZE):
+    """Get the local fields of documents.
+
+    :param document_pids: iterable of document pids.
+    :param org_pid: restrict to local fields of the given organisation.
+    :param size: number of document pids per query.
+    :returns: dictionary of local fields lists by document pid.
+    """
+    local_fields = {}
+    for pids in chunks(document_pids, size):
+        query_filters = [
+            Q('term', parent__type='doc'),
+            Q('terms', parent__pid=pids)
+        ]
+        if org_pid:
+            query_filters.append(Q('term', organisation__pid=org_pid))
+        query = LocalFieldsSearch()\
+            .query('bool', filter=query_filters)\
+            .source(['pid', 'parent'])
+        document_pid_by_id = {
+            hit.meta.id: hit.parent.pid for hit in query.scan()}
+        if not document_pid_by_id:
+            continue
+        for local_field in LocalField.get_records(list(document_pid_by_id)):
+            document_pid = document_pid_by_id[str(local_field.id)]
+            local_fields.setdefault(document_pid, []).append(local_field)
+    return local_fields
+
+
+def get_items_by_barcode(barcodes, org_pid):
+    """Get the items of an organisation with the given barcodes.
+
+    :param barcodes: iterable of barcodes.
+    :param org_pid: organisation pid.
+    :returns: dictionary of items by barcode, unknown barcodes are missing.
+    """
+    search = ItemsSearch().filter('term', organisation__pid=org_pid)
+    return {
+        barcode: item
+        for barcode, item in fetch_by_field(Item, search, barcode=barcodes)
+        if item
+    }
+
+
+def get_aggregated_counts(search, field, pids):
+    """Get the number of hits of a search for each pid.
+
+    :param search: search to restrict.
+    :param field: indexed field containing the pids.
+    :param pids: list of pids, should fit in one aggregation.
+    :returns: dictionary of number of hits by pid, pids without hit are
+              missing.
+    """
+    search = search \
+        .filter('terms', **{field.replace('.', '__'): pids}) \
+        .extra(size=0)
+    search.aggs.bucket('pids', 'terms', field=field, size=len(pids))
+    return {
+        bucket.key: bucket.doc_count
+        for bucket in search.execute().aggregations.pids.buckets
+    }
+
+
+def get_aggregated_pids(search, field, pids):
+    """Get the pids having at least one hit for a search.
+
+    :param search: search to restrict.
+    :param field: indexed field containing the pids.
+    :param pids: list of pids, should fit in one aggregation.
+    :returns: set of pids found in the search.
+    """
+    return set(get_aggregated_counts(search, field, pids))
+
+
+def get_linked_pids(pids, searches, size=TERMS_SIZE):
+    """Get the pids linked to at least one record of the given searches.
+
+    :param pids: iterable of pids.
+    :param searches: list of (search, indexed field containing the pids).
+    :param size: number of pids per aggregation.
+    :returns: set of linked pids.
+    """
+    linked_pids = set()
+    for values in chunks(pids, size):
+        for search, field in searches:
+            linked_pids |= get_aggregated_pids(search, field, values)
+    return linked_pids
+
+
+def get_items_reasons_not_to_delete(item_pids, size=TERMS_SIZE):
+    """Get the reasons not to delete items.
+
+    Loans, collections and open fees linked to the items are aggregated to
+    select the items which may be blocked. `reasons_not_to_delete` is then
+    called only for them, the result is thus the same as the record API.
+
+    :param item_pids: iterable of item pids.
+    :param size: number of item pids per query.
+    :returns: dictionary of reasons not to delete by item pid.
+    """
+    item_pids = list(item_pids)
+    linked_pids = get_linked_pids(item_pids, [
+        (LoansSearch().exclude('terms', state=[
+            LoanState.CANCELLED, LoanState.ITEM_RETURNED]),
+         'item_pid.value'),
+        (CollectionsSearch(), 'items.pid'),
+        (PatronTransactionsSearch().filter('term', status='open'),
+         'item.pid')
+    ], size)
+    reasons = {pid: {} for pid in item_pids}
+    items = get_records_by_pids(
+        Item, [pid for pid in item_pids if pid in linked_pids], size)
+    for pid, item in items.items():
+        reasons[pid] = item.reasons_not_to_delete()
+    return reasons
+
+
+def get_documents_reasons_not_to_delete(documents, size=TERMS_SIZE):
+    """Get the reasons not to delete documents.
+
+    Items, holdings, loans, order lines and related documents linked to
+    the documents are aggregated to select, with the harvested documents,
+    the documents which may be blocked. `reasons_not_to_delete` is then
+    called only for them.
+
+    :param documents: dictionary of documents by pid.
+    :param size: number of document pids per query.
+    :returns: dictionary of reasons not to delete by document pid.
+    """
+    linked_pids = get_linked_pids(documents, [
+        (ItemsSearch(), 'document.pid'),
+        (HoldingsSearch(), 'document.pid'),
+        (LoansSearch(), 'document_pid'),
+        (AcqOrderLinesSearch(), 'document.pid')
+    ] + [(DocumentsSearch(), field) for field in DOCUMENT_RELATION_FIELDS],
+        size)
+    return {
+        pid: document.reasons_not_to_delete()
+        if pid in linked_pids or document.get('harvested') else {}
+        for pid, document in documents.items()
+    }
+
+
+class BulkDeleter:
+    """Delete records by batches.
+
+    The records of a batch are deleted in dependency order (items, holdings,
+    documents, local fields) with one database commit and one ES bulk
+    request per index.
+    """
+
+    pid_types = ['item', 'hold', 'doc', 'lofi']
+
+    def __init__(self, batch_size=1000, dbcommit=True, delindex=True,
+                 before_flush=None):
+        """Constructor.
+
+        :param batch_size: number of records per batch.
+        :param dbcommit: commit the deletions into the database, they are
+                         rolled back otherwise.
+        :param delindex: remove the deleted records from the index.
+        :param before_flush: function called before a batch is deleted,
+                             i.e. to sync the backups of the records.
+        """
+        self.batch_size = batch_size
+        self.dbcommit = dbcommit
+        self.delindex = delindex and dbcommit
+        self.before_flush = before_flush
+        self.pending = {}
+        self.size = 0
+        self.deleted = {}
+        self._flushing = False
+
+    def __enter__(self):
+        """Context manager enter."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Context manager exit."""
+        if exc_type is None:
+            self.flush()
+
+    def add(self, record, callback=None):
+        """Add a record to delete.
+
+        :param record: record to delete.
+        :param callback: function called with the record and the error
+                         (None if the record has been deleted) once the
+                         batch is committed, or rolled back in dry run
+                         mode. A failed commit is given as the error of
+                         the records of the batch. Records added by a
+                         callback are deleted by the same flush, in a
+                         next batch.
+        """
+        pid_type = record.provider.pid_type
+        self.pending.setdefault(pid_type, []).append((record, callback))
+        self.size += 1
+        if not self._flushing and self.size >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Delete the pending records."""
+        if self._flushing or not self.pending:
+            return
+        self._flushing = True
+        try:
+            # the callbacks may add records or change others
+            while self.pending:
+                self._flush_batch()
+            if self.dbcommit:
+                self._commit({})
+            else:
+                db.session.rollback()
+        finally:
+            self.size = 0
+            self._flushing = False
+
+    def _flush_batch(self):
+        """Delete the pending records in one transaction.
+
+        The callbacks are called once the transaction is committed, or
+        rolled back in dry run mode.
+        """
+        if self.before_flush:
+            self.before_flush()
+        results, deleted_ids = [], {}
+        with phase('delete'):
+            for pid_type in self._pid_types():
+                records = self.pending.pop(pid_type, None)
+                if not records:
+                    continue
+                ids = self._delete(records, results)
+                if ids and self.delindex:
+                    self._delete_from_index(pid_type, ids)
+                if ids:
+                    deleted_ids[pid_type] = ids
+            if not self.dbcommit:
+                # dry run: the deletions must not be committed later
+                db.session.rollback()
+            else:
+                try:
+                    self._commit(deleted_ids)
+                except Exception as err:
+                    self._callbacks(results, err)
+                    raise
+        self._callbacks(results)
+
+    def _pid_types(self):
+        """Pending record types in dependency order."""
+        others = [t for t in self.pending if t not in self.pid_types]
+        return self.pid_types + others
+
+    def _delete(self, records, results):
+        """Delete records from the database without commit.
+
+        :param records: list of (record, callback).
+        :param results: list extended with (record, callback, error).
+        :returns: ids of the deleted records.
+        """
+        ids = []
+        for record, callback in records:
+            error = None
+            try:
+                with db.session.begin_nested():
+                    record.delete(dbcommit=False, delindex=False)
+                ids.append(record.id)
+            except Exception as err:
+                error = err
+            results.append((record, callback, error))
+        return ids
+
+    @staticmethod
+    def _callbacks(results, commit_error=None):
+        """Call the callbacks of a processed batch.
+
+        :param results: list of (record, callback, error).
+        :param commit_error: error of the batch commit.
+        """
+        for record, callback, error in results:
+            if callback:
+                callback(record, error or commit_error)
+
+    def _delete_from_index(self, pid_type, ids):
+        """Remove records from the index with one bulk request.
+
+        The index is refreshed, the deletability of the records of the next
+        types may depend on it.
+        """
+        index = build_alias_name(
+            current_app.config['RECORDS_REST_ENDPOINTS'][pid_type]
+            ['search_index'])
+
+        def delete_batch(batch):
+            actions = (
+                {'_op_type': 'delete', '_index': index, '_id': str(_id)}
+                for _id in batch
+            )
+            _, errors = bulk(
+                current_search_client, actions, raise_on_error=False,
+                raise_on_exception=False, refresh='wait_for')
+            if rejected_errors(errors):
+                raise BulkRejected(f'{index}: documents rejected')
+        indexing_controller().bulk(ids, delete_batch)
+
+    def _commit(self, deleted_ids):
+        """Commit the batch, restore the index if the commit fails."""
+        try:
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            if self.delindex:
+                for pid_type, ids in deleted_ids.items():
+                    indexing_controller().index(ids, pid_type)
+            raise
+        for pid_type, ids in deleted_ids.items():
+            self.deleted[pid_type] = self.deleted.get(pid_type, 0) + len(ids)
+
+
+class BulkReindexer:
+    """Collect records to reindex and index each of them only once.
+
+    Records added several times during a run are indexed only once when
+    the set is flushed.
+    """
+
+    def __init__(self, batch_size=None):
+        """Constructor.
+
+        :param batch_size: flush when this number of records is reached,
+                           only at the end if None.
+        """
+        self.batch_size = batch_size
+        self.ids = {}
+        self.size = 0
+
+    def __enter__(self):
+        """Context manager enter."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Context manager exit."""
+        if exc_type is None:
+            self.flush()
+
+    def add(self, record):
+        """Mark a record to reindex.
+
+        :param record: record to reindex.
+        """
+        ids = self.ids.setdefault(record.provider.pid_type, set())
+        if record.id not in ids:
+            ids.add(record.id)
+            self.size += 1
+        if self.batch_size and self.size >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Index the marked records through the indexing controller."""
+        if not self.size:
+            return
+        with phase('reindex'):
+            for pid_type, ids in self.ids.items():
+                indexing_controller().index(ids, pid_type)
+        self.ids = {}
+        self.size = 0
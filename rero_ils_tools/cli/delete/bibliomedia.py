@@ -20,51 +20,84 @@
 
 from __future__ import absolute_import, print_function
 
+import gzip
+import json
 import os
 from datetime import datetime
+from functools import partial
+from itertools import groupby
 
 import click
-from elasticsearch_dsl import Q
 from flask.cli import with_appcontext
 from rero_ils.modules.documents.api import Document
 from rero_ils.modules.holdings.api import Holding
 from rero_ils.modules.items.api import Item, ItemsSearch
-from rero_ils.modules.local_fields.api import LocalField, LocalFieldsSearch
+from rero_ils.modules.local_fields.api import LocalField
 from rero_ils.modules.operation_logs.api import OperationLogsSearch
-from rero_ils.modules.utils import JsonWriter
 
+from ...api import (BulkDeleter, BulkReindexer, get_aggregated_counts,
+                   get_items_reasons_not_to_delete,
+                   get_local_fields_by_document, get_records_by_pids)
+from ...instrumentation import count_records, phase
+from ...pool import WorkerPool
+from ...utils import chunks
+from ...writers import AsyncJsonWriter
 
-def delete_record(record, verbose):
-    """Delete record.
+# number of item pids per aggregation, must stay under ES max buckets
+AGGREGATION_SIZE = 5000
+# number of documents analysed together
+WINDOW_SIZE = 1000
 
-    :param record: record to delete_count.
+
+def report_deletion(record, error, verbose):
+    """Report a record which could not be deleted.
+
+    :param record: record to delete.
+    :param error: deletion error, None if the record has been deleted.
     :param verbose: verbose print.
-    :param delete: really delete record.
     """
-    reasons_not_to_delete = record.reasons_not_to_delete()
-    if reasons_not_to_delete:
-        if verbose:
-            click.secho(
-                '\tNOT DELETED:\t'
-                f'{type(record).__name__} {record.get("pid")}\t'
-                f'{reasons_not_to_delete}',
-                fg='yellow'
-            )
-        return False
-    record.delete(dbcommit=True, delindex=True)
-    return True
+    if error and verbose:
+        reasons_not_to_delete = record.reasons_not_to_delete() or error
+        click.secho(
+            '\tNOT DELETED:\t'
+            f'{type(record).__name__} {record.get("pid")}\t'
+            f'{reasons_not_to_delete}',
+            fg='yellow'
+        )
 
 
-def local_field_to_change(locf, doc, collection):
-    """Local field to change.
+def document_deleted(deleter, reindexer, local_fields, verbose):
+    """Build the callback deleting or changing the document local fields.
 
-    :param locf: local field to change.
-    :param doc: document to reindex.
+    :param deleter: BulkDeleter of the current run.
+    :param reindexer: BulkReindexer of the current run.
+    :param local_fields: list of (local field, fields without collection).
+    :param verbose: verbose print.
+    :returns: deletion callback of the document.
+    """
+    def callback(document, error):
+        report_deletion(document, error, verbose)
+        for local_field, fields in local_fields:
+            if error:
+                local_field_to_change(
+                    local_field, fields, document, deleter, reindexer)
+            else:
+                deleter.add(
+                    local_field,
+                    callback=partial(report_deletion, verbose=verbose))
+    return callback
+
+
+def remove_collection(fields, collection):
+    """Remove a collection from the fields of a local field.
+
+    :param fields: fields of the local field.
     :param collection: collection to delete from local field.
+    :returns: new fields of the local field.
     """
-    field_1 = locf['fields']['field_1']
+    fields = dict(fields)
     new_data = []
-    for data in field_1:
+    for data in fields.get('field_1', []):
         new_elements = []
         for data_element in data.split(' | '):
             if collection not in data_element:
@@ -72,14 +105,197 @@ def local_field_to_change(locf, doc, collection):
         if new_elements:
             new_data.append(' | '.join(new_elements))
     if new_data:
-        locf['fields']['field_1'] = new_data
+        fields['field_1'] = new_data
     else:
-        locf['fields'].pop('field_1')
+        fields.pop('field_1', None)
+    return fields
+
+
+def local_field_to_change(locf, fields, doc, deleter, reindexer):
+    """Local field to change.
+
+    :param locf: local field to change.
+    :param fields: new fields of the local field.
+    :param doc: document to reindex.
+    :param deleter: BulkDeleter of the current run.
+    :param reindexer: BulkReindexer of the current run.
+    """
+    locf['fields'] = fields
     if locf['fields']:
-        locf.update(data=locf, dbcommit=True, reindex=True)
+        locf.update(data=locf, dbcommit=False, reindex=False)
+        locf.commit()
+        reindexer.add(locf)
     else:
-        locf.delete(dbcommit=True, delindex=True)
-    doc.reindex()
+        deleter.add(locf)
+    reindexer.add(doc)
+
+
+def delete_document(document, items, local_fields, deleter, reindexer,
+                    verbose):
+    """Delete a document with its items and local fields.
+
+    :param document: document to delete.
+    :param items: items of the collection attached to the document.
+    :param local_fields: list of (local field, fields without collection).
+    :param deleter: BulkDeleter of the current run.
+    :param reindexer: BulkReindexer of the current run.
+    :param verbose: verbose print.
+    """
+    for item in items:
+        deleter.add(item, callback=partial(report_deletion, verbose=verbose))
+    deleter.add(document, callback=document_deleted(
+        deleter, reindexer, local_fields, verbose))
+
+
+def plan_record(record):
+    """Serialize a record for a deletion plan."""
+    return {
+        'id': str(record.id),
+        'revision_id': record.revision_id,
+        'data': record
+    }
+
+
+def load_plan_records(record_class, planned):
+    """Load the records of a deletion plan not changed since the plan.
+
+    :param record_class: class of the records.
+    :param planned: list of records serialized with plan_record.
+    :returns: dictionary of records by id, stale records are missing.
+    """
+    revisions = {record['id']: record['revision_id'] for record in planned}
+    if not revisions:
+        return {}
+    return {
+        str(record.id): record
+        for record in record_class.get_records(list(revisions))
+        if record.revision_id == revisions[str(record.id)]
+    }
+
+
+def apply_batch(entries, verbose):
+    """Apply a batch of a deletion plan.
+
+    :param entries: list of deletion plan entries.
+    :param verbose: verbose print.
+    :returns: number of deleted records by type and number of stale
+              entries.
+    """
+    documents = load_plan_records(
+        Document, [entry['document'] for entry in entries])
+    items = load_plan_records(
+        Item, [item for entry in entries for item in entry['items']])
+    local_fields = load_plan_records(
+        LocalField,
+        [locf for entry in entries for locf in entry['local_fields']])
+    stale = 0
+    deleter = BulkDeleter()
+    reindexer = BulkReindexer()
+    for entry in entries:
+        document = documents.get(entry['document']['id'])
+        entry_items = [items.get(item['id']) for item in entry['items']]
+        entry_local_fields = [
+            (local_fields.get(locf['id']), locf['fields'])
+            for locf in entry['local_fields']
+        ]
+        if not document or not all(entry_items) or not all(
+                locf for locf, _ in entry_local_fields):
+            stale += 1
+            document_pid = entry['document']['data']['pid']
+            click.secho(
+                f'\tSTALE:\tdocument pid: {document_pid} '
+                'changed since the plan creation', fg='yellow')
+            continue
+        delete_document(
+            document, entry_items, entry_local_fields, deleter, reindexer,
+            verbose)
+    deleter.flush()
+    reindexer.flush()
+    return {**deleter.deleted, 'stale': stale}
+
+
+def apply_plan(path, batch_size, workers, verbose):
+    """Apply a deletion plan with parallel batches.
+
+    :param path: deletion plan file.
+    :param batch_size: number of documents per batch.
+    :param workers: number of worker processes.
+    :param verbose: verbose print.
+    """
+    with gzip.open(path, 'rt') as plan:
+        header = json.loads(next(plan))
+        click.secho(
+            f'Apply deletion plan of collection: {header["collection"]} '
+            f'created: {header["created"]}', fg='red')
+        entries = (json.loads(line) for line in plan)
+        entries = (entry for entry in entries if not entry['do_not_delete'])
+        # every worker process deletes its batches with its own application
+        pool = WorkerPool(workers=workers, chunk_size=batch_size)
+        with phase('apply'):
+            deleted = pool.run(
+                partial(apply_batch, verbose=verbose), entries)
+    for _, error in pool.errors:
+        click.secho(f'\tERROR: batch failed: {error}', fg='red')
+    stale = deleted['stale']
+    click.echo(
+        f'Deleted documents: {deleted.get("doc", 0)}, '
+        f'items: {deleted.get("item", 0)}, '
+        f'local fields: {deleted.get("lofi", 0)}, Stale: {stale}')
+
+
+def get_checkouts_count(item_pids, size=AGGREGATION_SIZE):
+    """Get the number of checkouts of items from the operation logs.
+
+    :param item_pids: list of item pids.
+    :param size: number of item pids per aggregation.
+    :returns: dictionary of checkouts count by item pid.
+    """
+    query = OperationLogsSearch() \
+        .filter('term', record__type='loan') \
+        .filter('term', loan__trigger='checkout')
+    checkouts = {}
+    for pids in chunks(item_pids, size):
+        checkouts.update(get_aggregated_counts(query, 'loan.item.pid', pids))
+    return checkouts
+
+
+def get_collection_documents(search_collection, size=WINDOW_SIZE):
+    """Stream the documents of a collection with the data of their items.
+
+    Items are scanned sorted by document, so only one window of documents
+    is kept in memory whatever the size of the collection.
+
+    :param search_collection: collection name to search in the item notes.
+    :param size: number of documents per window.
+    :returns: generator of (document pid, document, items by pid,
+              checkouts count by item pid, reasons not to delete by item
+              pid, local fields).
+    """
+    query = ItemsSearch() \
+        .filter('term', notes__type='staff_note') \
+        .filter('match', notes__content=search_collection) \
+        .source(['pid', 'document']) \
+        .sort('document.pid') \
+        .params(preserve_order=True, scroll='30m')
+    # group by documents
+    document_items = (
+        (document_pid, [hit.pid for hit in hits])
+        for document_pid, hits in groupby(
+            query.scan(), key=lambda hit: hit.document.pid)
+    )
+    for window in chunks(document_items, size):
+        with phase('analyse'):
+            item_pids = [pid for _, pids in window for pid in pids]
+            checkouts = get_checkouts_count(item_pids)
+            items_reasons = get_items_reasons_not_to_delete(item_pids)
+            document_pids = [document_pid for document_pid, _ in window]
+            local_fields = get_local_fields_by_document(document_pids)
+            documents = get_records_by_pids(Document, document_pids)
+            items = get_records_by_pids(Item, item_pids)
+        for document_pid, pids in window:
+            yield (document_pid, documents.get(document_pid),
+                   {pid: items.get(pid) for pid in pids}, checkouts,
+                   items_reasons, local_fields.get(document_pid, []))
 
 
 def get_bibliomedia_id(document):
@@ -90,33 +306,60 @@ def get_bibliomedia_id(document):
 
 
 @click.command()
-@click.argument('collection')
+@click.argument('collection', required=False)
 @click.option('-s', '--save', default=None, help='Directory for saving files.')
 @click.option('-d', '--delete', is_flag=True, default=False,
               help='Realy delete records.')
+@click.option('-p', '--plan', 'plan', default=None,
+              help='Write a deletion plan file instead of deleting.')
+@click.option('-a', '--apply', 'apply', default=None,
+              help='Apply a deletion plan file.')
+@click.option('-b', '--batch_size', 'batch_size', type=int, default=100,
+              help='Number of documents per batch to apply a plan.')
+@click.option('-w', '--workers', 'workers', type=int, default=1,
+              help='Number of worker processes to apply a plan.')
 @click.option('-v', '--verbose', is_flag=True, default=False,
               help='Verbose print.')
 @with_appcontext
-def bibliomedia(collection, save, delete, verbose):
-    """Delete bibliomedia collection."""
+def bibliomedia(collection, save, delete, plan, apply, batch_size, workers,
+                verbose):
+    """Delete bibliomedia collection.
+
+    The deletion can be done in two phases: `--plan` analyses the
+    collection and writes the records to delete with their backup in a
+    plan file, `--apply` deletes the records of the plan which did not
+    change since then.
+    """
+    if apply:
+        apply_plan(apply, batch_size, workers, verbose)
+        return
+    if not collection:
+        click.secho('Missing collection argument.', fg='red')
+        exit()
     click.secho(f'Delete Bibliomedia Collection: {collection}', fg='red')
 
     if save:
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        doc_file = JsonWriter(
+        doc_file = AsyncJsonWriter(
             os.path.join(save, f'documents_{timestamp}.json'))
-        item_file = JsonWriter(
+        item_file = AsyncJsonWriter(
             os.path.join(save, f'items_{timestamp}.json'))
-        locf_file = JsonWriter(
+        locf_file = AsyncJsonWriter(
             os.path.join(save, f'local_fields_{timestamp}.json'))
-        doc_error_file = JsonWriter(
+        doc_error_file = AsyncJsonWriter(
             os.path.join(save, f'documents_error_{timestamp}.json'))
-        item_error_file = JsonWriter(
+        item_error_file = AsyncJsonWriter(
             os.path.join(save, f'items_error_{timestamp}.json'))
-        locf_error_file = JsonWriter(
+        locf_error_file = AsyncJsonWriter(
             os.path.join(save, f'local_fields_error_{timestamp}.json'))
         info = open(
             os.path.join(save, f'{collection}_{timestamp}.log'), 'w')
+    if plan:
+        plan_file = gzip.open(plan, 'wt')
+        plan_file.write(json.dumps({
+            'collection': collection,
+            'created': datetime.now().isoformat()
+        }) + '\n')
 
     # if there is a - in the collection name the elastic search is not working.
     collection_split = collection.split('-')
@@ -124,34 +367,29 @@ def bibliomedia(collection, save, delete, verbose):
     if len(collection_split) > 1:
         search_collection = collection_split[1]
 
-    query = ItemsSearch() \
-        .filter('term', notes__type='staff_note') \
-        .filter('match', notes__content=search_collection)
-    # group by documents
-    document_items = {}
-    for hit in query.source(['pid', 'document']).scan():
-        document_pid = hit.document.pid
-        document_items.setdefault(document_pid, [])
-        document_items[document_pid].append(hit.pid)
+    def sync_backups():
+        """Sync the backups of a batch before deleting it."""
+        if save:
+            for backup in doc_file, item_file, locf_file:
+                backup.sync(wait=True)
 
+    deleter = BulkDeleter(before_flush=sync_backups)
+    reindexer = BulkReindexer()
     idx = 0
     delete_count = 0
     checkouts_count = 0
-    for idx, document_pid in enumerate(document_items, 1):
+    groups = get_collection_documents(search_collection)
+    for idx, group in enumerate(groups, 1):
+        (document_pid, document, document_items, checkouts, items_reasons,
+         local_fields) = group
+        count_records(1, 'documents')
         do_not_delete = False
-        item_pids = document_items[document_pid]
-        document = Document.get_record_by_pid(document_pid)
         # items
         items = []
-        for item_pid in item_pids:
-            item = Item.get_record_by_pid(item_pid)
-            reasons_not_to_delete = item.reasons_not_to_delete()
+        for item_pid, item in document_items.items():
+            reasons_not_to_delete = items_reasons[item_pid]
             checkout_count = item.get('legacy_checkout_count', 0)
-            checkout_count += OperationLogsSearch() \
-                .filter('term', record__type='loan') \
-                .filter('term', loan__item__pid=item_pid) \
-                .filter('term', loan__trigger='checkout') \
-                .count()
+            checkout_count += checkouts.get(item_pid, 0)
             checkouts_count += checkout_count
 
             if reasons_not_to_delete:
@@ -173,20 +411,6 @@ def bibliomedia(collection, save, delete, verbose):
                 'item': item,
                 'reasons_not_to_delete': reasons_not_to_delete
             })
-        # local fields
-        query_filters = [
-            Q('term', parent__type='doc'),
-            Q('term', parent__pid=document_pid)
-        ]
-        query = LocalFieldsSearch()\
-            .query('bool', filter=query_filters)\
-            .source(['pid'])
-
-        local_fields = []
-        for hit in query.scan():
-            local_field_pid = hit.pid
-            local_field = LocalField.get_record_by_pid(local_field_pid)
-            local_fields.append(local_field)
 
         msg = (f'{idx}\tDocument id: {get_bibliomedia_id(document)}\t'
                f'item barcode: {item.get("barcode")}\t'
@@ -237,15 +461,36 @@ def bibliomedia(collection, save, delete, verbose):
 
         if not do_not_delete:
             delete_count += 1
-        if delete and not do_not_delete:
-            for item in items:
-                delete_record(item['item'], verbose)
-            if delete_record(document, verbose):
-                for local_field in local_fields:
-                    delete_record(local_field, verbose)
-            else:
-                for local_field in local_fields:
-                    local_field_to_change(local_field, document, collection)
+        local_fields = [
+            (local_field, remove_collection(local_field['fields'], collection))
+            for local_field in local_fields
+        ]
+        if plan:
+            plan_file.write(json.dumps({
+                'do_not_delete': do_not_delete,
+                'document': plan_record(document),
+                'items': [
+                    dict(plan_record(item['item']),
+                         reasons_not_to_delete=item['reasons_not_to_delete'])
+                    for item in items
+                ],
+                'local_fields': [
+                    dict(plan_record(local_field), fields=fields)
+                    for local_field, fields in local_fields
+                ]
+            }) + '\n')
+        elif delete and not do_not_delete:
+            delete_document(
+                document, [item['item'] for item in items], local_fields,
+                deleter, reindexer, verbose)
+    deleter.flush()
+    reindexer.flush()
+    if plan:
+        plan_file.close()
+    if save:
+        for out_file in (doc_file, item_file, locf_file, doc_error_file,
+                         item_error_file, locf_error_file):
+            out_file.close()
 
     msg = f'Count: {idx}, Deleted: {delete_count}, Checkouts: {checkouts_count}'
     click.echo(msg)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""RERO ILS desherbage campaign command line interface."""
+
+from __future__ import absolute_import, print_function
+
+import csv
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stderr, redirect_stdout
+from multiprocessing import get_context
+
+import click
+from flask.cli import ScriptInfo
+
+from ... import create_app
+from .vs import vs
+
+
+def read_manifest(manifest):
+    """Read a desherbage campaign manifest.
+
+    Each row contains the library pid, the library code and the item
+    barcodes file. Empty rows and rows starting with # are ignored.
+
+    :param manifest: opened CSV manifest file.
+    :returns: list of (library pid, library code, barcodes file) and list
+              of error messages of the invalid rows.
+    """
+    libraries, errors = [], []
+    reader = csv.reader(manifest)
+    for row in reader:
+        row = [value.strip() for value in row]
+        if not row or not row[0] or row[0].startswith('#'):
+            continue
+        if len(row) < 3 or not all(row[:3]):
+            errors.append(
+                f'line {reader.line_num}: library pid, library code and '
+                f'barcodes file expected: {",".join(row)}')
+            continue
+        library_pid, library_code, barcodes_file = row[:3]
+        if not os.path.isfile(barcodes_file):
+            errors.append(
+                f'line {reader.line_num}: {barcodes_file} does not exist')
+            continue
+        libraries.append((library_pid, library_code, barcodes_file))
+    return libraries, errors
+
+
+def run_library(library_pid, library_code, barcodes_file, save, noupdate):
+    """Run the vs command for one library in its own application.
+
+    The command output is written in the library output directory.
+
+    :param library_pid: the PID of the library.
+    :param library_code: the code of the library.
+    :param barcodes_file: text file with the item barcodes to delete.
+    :param save: the directory where to save the library output files.
+    :param noupdate: vs noupdate flag.
+    :returns: None if the run succeeded, the error message otherwise.
+    """
+    args = [barcodes_file, '-l', library_pid, '-c', library_code, '-s', save]
+    if not noupdate:
+        args.append('-n')
+    with open(os.path.join(save, 'vs.out'), 'w') as out, \
+            redirect_stdout(out), redirect_stderr(out):
+        try:
+            vs.main(args=args, obj=ScriptInfo(create_app=create_app),
+                    standalone_mode=False)
+        except (Exception, SystemExit) as err:
+            # vs exits on invalid inputs
+            print(f'ERROR: {err}', file=sys.stderr)
+            return str(err) or type(err).__name__
+    return None
+
+
+@click.command('vs_campaign')
+@click.argument('manifest', type=click.File('r'))
+@click.option('-n', '--noupdate', is_flag=True, default=True,
+              help='No Update.')
+@click.option('-s', '--save', required=True,
+              help='Directory to saving files, one sub directory by library.')
+@click.option('-j', '--jobs', 'jobs', type=int, default=2,
+              help='Number of libraries processed in parallel.')
+def vs_campaign(manifest, noupdate, save, jobs):
+    """Delete items of several libraries in parallel.
+
+    manifest: CSV file with library pid, library code and item barcodes
+    file per row.
+    :param save: The directory where to save output files.
+    :param jobs: The number of parallel worker processes.
+    """
+    libraries, errors = read_manifest(manifest)
+    for error in errors:
+        click.secho(f'   manifest {error}', fg='red')
+    click.secho(
+        f'Desherbage campaign: {len(libraries)} libraries, {jobs} jobs',
+        fg='red')
+    failed = 0
+    # every worker starts its own application with its own connections
+    with ProcessPoolExecutor(
+            max_workers=jobs, mp_context=get_context('spawn')) as executor:
+        futures = {}
+        for library_pid, library_code, barcodes_file in libraries:
+            library_save = os.path.join(save, library_code)
+            os.makedirs(library_save, exist_ok=True)
+            future = executor.submit(
+                run_library, library_pid, library_code,
+                os.path.abspath(barcodes_file), library_save, noupdate)
+            futures[future] = library_code
+        for future in as_completed(futures):
+            library_code = futures[future]
+            error = future.result()
+            if error:
+                failed += 1
+                click.secho(f'   {library_code}: failed {error}', fg='red')
+            else:
+                click.secho(f'   {library_code}: done', fg='green')
+    click.secho(
+        f'Libraries: {len(libraries)}, Failed: {failed}, '
+        f'Invalid rows: {len(errors)}', fg='green')
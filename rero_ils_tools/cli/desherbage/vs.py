@@ -24,18 +24,28 @@ import json
 import os
 import sys
 from datetime import datetime
+from functools import partial
 
 import click
-from elasticsearch_dsl import Q
 from flask.cli import with_appcontext
+from invenio_db import db
 from rero_ils.modules.api import IlsRecordError
 from rero_ils.modules.documents.api import Document
 from rero_ils.modules.documents.utils import title_format_text_head
 from rero_ils.modules.holdings.api import Holding
-from rero_ils.modules.items.api import Item, ItemsSearch
+from rero_ils.modules.items.api import ItemsSearch
 from rero_ils.modules.libraries.api import Library
-from rero_ils.modules.local_fields.api import LocalField, LocalFieldsSearch
-from rero_ils.modules.utils import JsonWriter
+
+from ...api import (TERMS_SIZE, BulkDeleter, BulkReindexer,
+                   get_aggregated_counts, get_documents_reasons_not_to_delete,
+                   get_items_by_barcode, get_items_reasons_not_to_delete,
+                   get_local_fields_by_document, get_records_by_pids)
+from ...instrumentation import count_records, phase
+from ...utils import chunks, remove_subfields
+from ...writers import AsyncJsonWriter
+
+# number of barcodes resolved per query
+BARCODES_SIZE = 1000
 
 
 def validate_inputs(library_pid, save):
@@ -56,111 +66,131 @@ def write_to_log_file(msg, info):
     info.write(msg + '\n')
 
 
-def get_document_local_fields(document_pid, org_pid):
-    """."""
-    query_filters = [
-        Q('term', parent__type='doc'),
-        Q('term', parent__pid=document_pid),
-        Q('term', organisation__pid=org_pid),
-    ]
-    query = LocalFieldsSearch()\
-        .query('bool', filter=query_filters)\
-        .source(['pid'])
-
-    local_fields = []
-    for hit in query.scan():
-        local_field_pid = hit.pid
-        local_field = LocalField.get_record_by_pid(local_field_pid)
-        local_fields.append(local_field)
-    return local_fields
-
-
-def delete_library_code(data, text_1, text_2):
-    """Delete the library code from local fields."""
-    data_field = ''
-    if f'$2 {text_2}' in data:
-        dollar_2 = data.split('$2')
-        for a in dollar_2:
-            if text_2 in a:
-                dollar_2.remove(a)
-        if len(dollar_2) > 1:
-            for a in dollar_2:
-                if a == '':
-                    a = '$2'
-                data_field += a
-    elif f'$a {text_1}' in data:
-        dollar_a = data.split('$a')
-        for a in dollar_a:
-            if text_1 in a:
-                dollar_a.remove(a)
-        if len(dollar_a) > 1:
-            for a in dollar_a:
-                if a == '':
-                    a = '$a'
-                data_field += a
-    return data_field
+def library_code_patterns(library_code):
+    """Subfields patterns of a library code in local fields.
+
+    :param library_code: the code of the library.
+    :returns: dictionary of text to remove by subfield code.
+    """
+    return {'a': library_code, '2': f'cdu-{library_code}'}
+
+
+def resolve_barcodes(infile, org_pid, size=BARCODES_SIZE):
+    """Resolve the item barcodes of a file by chunks.
+
+    A barcode is resolved only once, its next lines are flagged as
+    duplicates without item.
+
+    :param infile: file with one item barcode per line.
+    :param org_pid: organisation pid.
+    :param size: number of barcodes per query.
+    :returns: generator of (barcode, item or None, reasons not to delete,
+              duplicate).
+    """
+    seen = set()
+    for barcodes in chunks((line.rstrip() for line in infile), size):
+        items = get_items_by_barcode(set(barcodes) - seen, org_pid)
+        items_reasons = get_items_reasons_not_to_delete(
+            [item.pid for item in items.values()])
+        for barcode in barcodes:
+            if barcode in seen:
+                yield barcode, None, None, True
+                continue
+            seen.add(barcode)
+            item = items.get(barcode)
+            reasons = items_reasons[item.pid] if item else None
+            yield barcode, item, reasons, False
 
 
 def update_local_fields(
         local_fields, library_code, document, docs_file,
-        local_fields_list, document_pid, dbcommit, reindex):
-    """Delete library code from local fields."""
+        local_fields_list, document_pid, deleter, reindexer):
+    """Delete library code from local fields.
+
+    The changes are committed with the deleter batches or at the end of
+    `manage_documents`, the changed local fields and their document are
+    marked to be reindexed.
+    """
+    patterns = library_code_patterns(library_code)
     for record in local_fields:
+        changed = False
         fields = list(record.get('fields', {}).keys())
         for field in fields:
-            text_1 = f'{library_code}'
-            text_2 = f'cdu-{library_code}'
-            data_field = ' '.join([
-                str(elem) for elem in record['fields'][field]])
-            if text_1 in data_field or text_2 in data_field:
+            values, removed = remove_subfields(
+                record['fields'][field], patterns)
+            if removed:
+                changed = True
                 docs_file.write(document)
                 msg = f"{document_pid}: {record.pid}: {record['fields'][field]}"
                 local_fields_list.write(msg + '\n')
-                field_data = delete_library_code(data_field, text_1, text_2)
-                if not field_data:
+                if not values:
                     del record['fields'][field]
                 else:
-                    record['fields'][field] = [field_data]
-        if len(record.get('fields', {}).keys()):
-            record.update(record, dbcommit=dbcommit, reindex=reindex)
+                    record['fields'][field] = values
+        if not record.get('fields'):
+            deleter.add(record)
+        elif changed:
+            record.update(record, dbcommit=False, reindex=False)
+            record.commit()
+            reindexer.add(record)
         else:
-            record.delete(record, dbcommit=dbcommit, delindex=reindex)
-
-
-def number_of_items(library_pid, document_pid):
-    """Get number of items for given library."""
-    query_filters = [
-        Q('term', document__pid=document_pid),
-        Q('term', library__pid=library_pid)
-    ]
-    query = ItemsSearch()\
-        .query('bool', filter=query_filters)\
-        .source(['pid'])
-    return query.count()
-
-
-def delete_documents(document_pids, deleted_docs_file):
-    """Attempt to delete documents."""
-    for document_pid in document_pids:
-        document = Document.get_record_by_pid(document_pid)
-        if document:
-            can, _ = document.can_delete
-            if can:
+            continue
+        reindexer.add(document)
+
+
+def number_of_items(library_pid, document_pids, size=TERMS_SIZE):
+    """Get number of items of documents for given library.
+
+    :param library_pid: library pid.
+    :param document_pids: list of document pids.
+    :param size: number of document pids per aggregation.
+    :returns: dictionary of number of items by document pid, documents
+              without items are missing.
+    """
+    query = ItemsSearch().filter('term', library__pid=library_pid)
+    counts = {}
+    for pids in chunks(document_pids, size):
+        counts.update(get_aggregated_counts(query, 'document.pid', pids))
+    return counts
+
+
+def document_deleted(document, error):
+    """Report a document which could not be deleted."""
+    if error:
+        click.echo(error)
+        click.echo(f'ERROR: Unable to delete document_pid:{document.pid}')
+
+
+def delete_documents(documents, deleted_docs_file, dbcommit, delindex):
+    """Attempt to delete documents.
+
+    :param documents: dictionary of affected documents by pid.
+    :param deleted_docs_file: AsyncJsonWriter to backup the deleted
+                              documents.
+    :param dbcommit: commit the deletions into the database.
+    :param delindex: remove the deleted documents from the index.
+    """
+    reasons = get_documents_reasons_not_to_delete(documents)
+    with BulkDeleter(
+            dbcommit=dbcommit, delindex=delindex,
+            before_flush=partial(deleted_docs_file.sync, wait=True)
+    ) as deleter:
+        for document_pid, document in documents.items():
+            if not reasons[document_pid]:
                 deleted_docs_file.write(document)
-                try:
-                    document.delete(document, dbcommit=True, delindex=True)
-                except Exception as error:
-                    click.echo(error)
-                    click.echo(
-                        f'ERROR: Unable to delete document_pid:{document_pid}')
-                
+                deleter.add(document, callback=document_deleted)
+
 
 def manage_documents(
-        library_pid, document_pids, info, docs_file, docs_list, org_pid,
+        library_pid, documents, info, docs_file, docs_list, org_pid,
         library_code, local_fields_list, dbcommit, reindex):
-    """Update document if needed."""
-    for document_pid in document_pids:
-        document = Document.get_record_by_pid(document_pid)
+    """Update document if needed.
+
+    :param documents: dictionary of affected documents by pid.
+    """
+    items_count = number_of_items(library_pid, list(documents))
+    documents_without_items = {}
+    for document_pid, document in documents.items():
         to_print = False
         seriesStatement = document.get('seriesStatement', [])
         for statement in seriesStatement:
@@ -181,18 +211,31 @@ def manage_documents(
                         links = f"{links} {link}"
             msg = f'{document.pid}: {links} | {sort_title}'
             docs_list.write(msg + '\n')
-        if not number_of_items(library_pid, document_pid):
-            local_fields = get_document_local_fields(document_pid, org_pid)
+        if not items_count.get(document_pid):
+            documents_without_items[document_pid] = document
+    local_fields = get_local_fields_by_document(
+        documents_without_items, org_pid)
+    reindexer = BulkReindexer()
+    with BulkDeleter(dbcommit=dbcommit, delindex=reindex) as deleter:
+        for document_pid, document in documents_without_items.items():
             update_local_fields(
-                local_fields, library_code, document, docs_file,
-                local_fields_list, document_pid, dbcommit, reindex)
+                local_fields.get(document_pid, []), library_code, document,
+                docs_file, local_fields_list, document_pid, deleter,
+                reindexer)
+    if dbcommit:
+        # local fields updated after the last deletion batch
+        db.session.commit()
+    if dbcommit and reindex:
+        reindexer.flush()
+
 
+def manage_holdings(holdings, info, holdings_list):
+    """List of serial holdings.
 
-def manage_holdings(holding_pids, info, holdings_list):
-    """List of serial holdings."""
-    for holding_pid in holding_pids:
-        holding = Holding.get_record_by_pid(holding_pid)
-        if holding and holding.holdings_type == 'serial':
+    :param holdings: dictionary of affected holdings by pid.
+    """
+    for holding in holdings.values():
+        if holding.holdings_type == 'serial':
             msg = f'{holding.pid}'
             holdings_list.write(msg + '\n')
 
@@ -222,11 +265,12 @@ def vs(
     click.secho(f'Delete items for library: {library.get("name")}', fg='red')
 
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    docs_file = JsonWriter(
+    docs_file = AsyncJsonWriter(
         os.path.join(save, f'documents_{timestamp}.json'))
-    deleted_docs_file = JsonWriter(
+    deleted_docs_file = AsyncJsonWriter(
         os.path.join(save, f'deleted_documents_{timestamp}.json'))
-    items_file = JsonWriter(os.path.join(save, f'items_{timestamp}.json'))
+    items_file = AsyncJsonWriter(
+        os.path.join(save, f'items_{timestamp}.json'))
     docs_list = open(
         os.path.join(
             save, f'documents_partof_seriesStatement_{timestamp}.txt'), 'w')
@@ -237,52 +281,75 @@ def vs(
         os.path.join(save, f'local_fields_{timestamp}.txt'), 'w')
 
     org_pid = library.organisation_pid
-    barcodes = infile.readlines()
     holding_pids, document_pids = [], []
     items_not_in_db, items_not_deleted, items_deleted = 0, 0, 0
-    for idx, line in enumerate(barcodes, 1):
-        barcode = line.rstrip()
-        item = Item.get_item_by_barcode(barcode, org_pid)
-        if not item:
+    items_duplicated = 0
+
+    def item_deleted(item, error):
+        """Log the deletion of an item."""
+        nonlocal items_deleted, items_not_deleted
+        barcode = item.get('barcode')
+        if error is None:
+            items_deleted += 1
+            msg = (f'Item barcode: "{barcode}" deleted from database.')
+            holding_pids.append(item.holding_pid)
+            document_pids.append(item.document_pid)
+        elif isinstance(error, IlsRecordError.NotDeleted):
+            msg = (f'Item barcode: "{barcode}" unable to delete.')
+            items_not_deleted += 1
+        else:
+            msg = (f'Item barcode: "{barcode}" unable to delete: {error}')
+            items_not_deleted += 1
+        write_to_log_file(msg, info)
+
+    # the items backup of a batch is on disk before its deletion
+    deleter = BulkDeleter(
+        dbcommit=dbcommit, delindex=reindex,
+        before_flush=partial(items_file.sync, wait=True))
+    idx = 0
+    barcodes = resolve_barcodes(infile, org_pid)
+    for idx, (barcode, item, reasons, duplicate) in enumerate(barcodes, 1):
+        count_records(1, 'items')
+        if duplicate:
+            msg = (f'Item barcode: "{barcode}" is a duplicate in the file.')
+            write_to_log_file(msg, info)
+            items_duplicated += 1
+        elif not item:
             msg = (f'Item barcode: "{barcode}" does not exist in database.')
             write_to_log_file(msg, info)
             items_not_in_db +=1
-        elif item.reasons_not_to_delete():
-            reasons = item.reasons_not_to_delete()
-            can, reasons = item.can_delete
+        elif reasons:
             text = 'can not be deleted. reasons:'
             msg = (f'Item barcode: "{barcode}" {text} {json.dumps(reasons)}')
             write_to_log_file(msg, info)
             items_not_deleted += 1
         else:
-            document_pid = item.document_pid
-            holding_pid = item.holding_pid
-            try:
-                items_file.write(item)
-                item.delete(item, dbcommit=dbcommit, delindex=reindex)
-                items_deleted += 1
-                msg = (f'Item barcode: "{barcode}" deleted from database.')
-                write_to_log_file(msg, info)
-                holding_pids.append(holding_pid)
-                document_pids.append(document_pid)
-            except IlsRecordError.NotDeleted:
-                msg = (f'Item barcode: "{barcode}" unable to delete.')
-                write_to_log_file(msg, info)
-                items_not_deleted += 1
-            except Exception as error:
-                msg = (f'Item barcode: "{barcode}" unable to delete: {error}')
-                write_to_log_file(msg, info)
-                items_not_deleted += 1
-    
-    manage_holdings(list(set(holding_pids)), info, holdings_list)
-    manage_documents(
-        library_pid, list(set(document_pids)), info, docs_file, docs_list,
-        org_pid, library_code, local_fields_list, dbcommit, reindex)
-    delete_documents(list(set(document_pids)), deleted_docs_file)
+            items_file.write(item)
+            deleter.add(item, callback=item_deleted)
+    deleter.flush()
+
+    # affected holdings and documents are loaded once for all the phases
+    holdings = get_records_by_pids(Holding, set(holding_pids))
+    documents = get_records_by_pids(Document, set(document_pids))
+    with phase('holdings'):
+        manage_holdings(holdings, info, holdings_list)
+    with phase('documents'):
+        manage_documents(
+            library_pid, documents, info, docs_file, docs_list,
+            org_pid, library_code, local_fields_list, dbcommit, reindex)
+    # the dry run deletions are rolled back, the documents still have items
+    if dbcommit:
+        with phase('delete documents'):
+            delete_documents(
+                documents, deleted_docs_file, dbcommit, reindex)
+    for out_file in docs_file, deleted_docs_file, items_file:
+        out_file.close()
     count = f'Count: {idx}'
     deleted = f', Deleted: {items_deleted}'
     not_in_db = f', Not in DB: {items_not_in_db}'
     not_deleted = f', Not deleted: {items_not_deleted}'
-    msg = f'{count}{deleted}{not_in_db}{not_deleted}'
+    duplicated = f', Duplicates: {items_duplicated}'
+    msg = f'{count}{deleted}{not_in_db}{not_deleted}{duplicated}'
     click.secho(msg, fg='green')
-    assert idx == items_deleted + items_not_in_db + items_not_deleted
+    assert idx == items_deleted + items_not_in_db + items_not_deleted + \
+        items_duplicated
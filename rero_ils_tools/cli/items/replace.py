@@ -27,9 +27,13 @@ import click
 from flask import current_app
 from flask.cli import with_appcontext
 from invenio_db import db
-from rero_ils.modules.items.api import Item, ItemsIndexer
+from rero_ils.modules.items.api import Item
 from rero_ils.modules.utils import JsonWriter, read_json_record
 
+from ...api import fetch_many
+from ...indexing import indexing_controller
+from ...progress import ProgressReporter
+
 
 @click.command('items')
 @click.option('-l', '--lazy', 'lazy', is_flag=True, default=False)
@@ -64,17 +68,23 @@ def items_replace(
         file_data = json.load(infile)
 
     click.secho(f'Replacing item records', fg='green')
+    name, _ = os.path.splitext(infile.name)
+    progress = ProgressReporter(
+        'items', total=None if lazy else len(file_data),
+        log_file=f'{name}_log.txt' if verbose else None)
 
     ids = []
-    for counter, data in enumerate(file_data, 1):
+    # items are loaded from the database by chunks
+    records = fetch_many(Item, file_data, key=lambda data: data.get('pid'))
+    for counter, (data, db_record) in enumerate(records, 1):
         item_pid = data.get('pid')
         if not item_pid:
-            click.secho(f'item # {counter} missing pid field', fg='red')
+            progress.log(f'item # {counter} missing pid field')
+            progress.advance(errors=1)
             if save_errors:
                 error_file.write(data)
             continue
 
-        db_record = Item.get_record_by_pid(item_pid)
         # No replace is possible in the following cases:
         # 1. item is not in database
         # 2. item of type issue and there is a new circ_category or location
@@ -92,8 +102,8 @@ def items_replace(
                     )
             )
         ):
-            click.secho(
-                f'unable to replace item # {counter} pid {item_pid}', fg='red')
+            progress.log(f'unable to replace item # {counter} pid {item_pid}')
+            progress.advance(errors=1)
             if save_errors:
                 error_file.write(data)
             continue
@@ -102,24 +112,23 @@ def items_replace(
             new_record = db_record.replace(
                 data, dbcommit=False, reindex=False)
             new_record.commit()
-            # TODO: remove this line when bulk indexing problem works
-            new_record.reindex()
             ids.append(new_record.id)
-            click.secho(f'record # {counter} replaced', fg='green')
+            progress.log(f'record # {counter} replaced')
+            progress.advance(replaced=1)
             if output:
                 out_file.write(new_record)
         except Exception as err:
-            text = f'record# {counter} pid {item_pid} failed replace {err}'
-            click.secho(text, fg='red')
+            progress.log(
+                f'record# {counter} pid {item_pid} failed replace {err}')
+            progress.advance(errors=1)
             if save_errors:
                 error_file.write(data)
         # TODO: create a separate loop for indexing and commits
         if counter % 1000 == 0:
             db.session.commit()
-            ItemsIndexer().bulk_index(ids)
-            ItemsIndexer().process_bulk_queue()
+            indexing_controller().index(ids, 'item')
             ids = []
     if ids:
         db.session.commit()
-        ItemsIndexer().bulk_index(ids)
-        ItemsIndexer().process_bulk_queue()
+        indexing_controller().index(ids, 'item')
+    progress.close()
@@ -22,31 +22,46 @@ from __future__ import absolute_import, print_function
 
 import json
 import os
+import threading
 
 import click
 from flask import current_app
 from flask.cli import with_appcontext
 from invenio_db import db
-from rero_ils.modules.items.api import Item, ItemsIndexer
+from rero_ils.modules.items.api import Item
 from rero_ils.modules.utils import JsonWriter, read_json_record
 
+from ...api import fetch_many
+from ...indexing import indexing_controller
+from ...instrumentation import count_records
+from ...pipeline import Pipeline, Stage
+from ...progress import ProgressReporter
+from ...utils import chunks
+
 
 @click.command('items')
 @click.option('-l', '--lazy', 'lazy', is_flag=True, default=False)
 @click.option('-e', '--save_errors', 'save_errors')
 @click.option('-o', '--output', 'output')
+@click.option('-b', '--batch_size', 'batch_size', type=int, default=1000,
+              help='Number of items per commit and bulk indexing.')
+@click.option('-w', '--workers', 'workers', type=int, default=2,
+              help='Number of batches written and indexed in parallel.')
 @click.option('-v', '--verbose', 'verbose', is_flag=True, default=False)
 @click.option('-d', '--debug', 'debug', is_flag=True, default=False)
 @click.argument('infile', type=click.File('r'))
 @with_appcontext
 def items_update(
-    infile, lazy, save_errors, output, verbose, debug):
+    infile, lazy, save_errors, output, batch_size, workers, verbose,
+        debug):
     """Update item records.
 
     infile: JSON file contains new item records to update.
     :param lazy: lazy reads file.
     :param save_errors: save error records to file.
     :param output: successfully modified records to file.    
+    :param batch_size: number of items per commit and bulk indexing.
+    :param workers: number of batches written and indexed in parallel.
     """
     if output:
         name, ext = os.path.splitext(infile.name)
@@ -57,6 +72,13 @@ def items_update(
         name, ext = os.path.splitext(infile.name)
         err_file_name = f'{name}_errors{ext}'
         error_file = JsonWriter(err_file_name)
+        # the write workers share the error file
+        error_lock = threading.Lock()
+
+        def save_error(data):
+            """Write a record to the error file."""
+            with error_lock:
+                error_file.write(data)
 
     if lazy:
         file_data = read_json_record(infile)
@@ -64,62 +86,114 @@ def items_update(
         file_data = json.load(infile)
 
     click.secho(f'Updating item records', fg='green')
+    name, _ = os.path.splitext(infile.name)
+    progress = ProgressReporter(
+        'items', total=None if lazy else len(file_data),
+        log_file=f'{name}_log.txt' if verbose else None)
 
-    ids = []
-    for counter, data in enumerate(file_data, 1):
-        item_pid = data.get('pid')
-        if not item_pid:
-            click.secho(f'item # {counter} missing pid field', fg='red')
-            if save_errors:
-                error_file.write(data)
-            continue
-
-        db_record = Item.get_record_by_pid(item_pid)
-        # No update is possible in the following cases:
-        # 1. item is not in database
-        # 2. item of type issue and there is a new circ_category or location
-        if not db_record or (
-            db_record.item_record_type == 'issue' and
-            (
+    def write(batch):
+        """Update the items of a batch in one transaction.
+
+        The updated items are counted once the batch is committed.
+        """
+        ids, updated, messages = [], [], []
+        # items are loaded from the database by chunks
+        records = fetch_many(
+            Item, batch, len(batch), key=lambda entry: entry[1].get('pid'))
+        for (counter, data), db_record in records:
+            item_pid = data.get('pid')
+            if not item_pid:
+                progress.log(f'item # {counter} missing pid field')
+                progress.advance(errors=1)
+                if save_errors:
+                    save_error(data)
+                continue
+
+            # No update is possible in the following cases:
+            # 1. item is not in database
+            # 2. item of type issue and there is a new circ_category or
+            #    location
+            if not db_record or (
+                db_record.item_record_type == 'issue' and
+                (
                     (
                         data.get('item_type')
-                        and data.get('item_type') != db_record.get('item_type')
+                        and data.get('item_type') != db_record.get(
+                            'item_type')
                     )
-                or
+                    or
                     (
                         data.get('location')
                         and data.get('location') != db_record.get('location')
                     )
-            )
-        ):
-            click.secho(
-                f'unable to modify item # {counter} pid {item_pid}', fg='red')
-            if save_errors:
-                error_file.write(data)
-            continue
+                )
+            ):
+                progress.log(
+                    f'unable to modify item # {counter} pid {item_pid}')
+                progress.advance(errors=1)
+                if save_errors:
+                    save_error(data)
+                continue
 
+            try:
+                new_record = db_record.update(
+                    {**db_record, **data}, dbcommit=False, reindex=False)
+                new_record.commit()
+                ids.append(new_record.id)
+                messages.append(f'record # {counter} updated')
+                if output:
+                    updated.append(dict(new_record))
+            except Exception as err:
+                progress.log(
+                    f'record# {counter} pid {item_pid} failed update {err}')
+                progress.advance(errors=1)
+                if save_errors:
+                    save_error(data)
         try:
-            new_record = db_record.update(
-                {**db_record, **data}, dbcommit=False, reindex=False)
-            new_record.commit()
-            # TODO: remove this line when bulk indexing problem works
-            new_record.reindex()
-            ids.append(new_record.id)
-            click.secho(f'record # {counter} updated', fg='green')
-            if output:
-                out_file.write(new_record)
-        except Exception as err:
-            text = f'record# {counter} pid {item_pid} failed update {err}'
-            click.secho(text, fg='red')
-            if save_errors:
-                error_file.write(data)
-        # TODO: create a separate loop for indexing and commits
-        if counter % 1000 == 0:
             db.session.commit()
-            ItemsIndexer().bulk_index(ids)
-            ItemsIndexer().process_bulk_queue()
-            ids = []
-    if ids:
-        db.session.commit()
-        ItemsIndexer().bulk_index(ids)
-        ItemsIndexer().process_bulk_queue()
+        except Exception:
+            # the updates of the batch are rolled back by on_error
+            progress.advance(len(ids), errors=len(ids))
+            raise
+        for msg in messages:
+            progress.log(msg)
+        progress.advance(len(ids), updated=len(ids))
+        count_records(len(batch), 'items')
+        return ids, updated
+
+    def index(result):
+        """Index the items of a committed batch."""
+        ids, updated = result
+        if ids:
+            indexing_controller().index(ids, 'item')
+        return updated or None
+
+    def write_output(updated):
+        """Write the updated items to the output file."""
+        for record in updated:
+            out_file.write(record)
+
+    def on_error(stage, batch, err):
+        """Report a failed stage."""
+        if stage.name == 'write':
+            db.session.rollback()
+            click.secho(f'batch failed update {err}', fg='red')
+            if save_errors:
+                for _, data in batch:
+                    save_error(data)
+        else:
+            click.secho(f'batch failed {stage.name} {err}', fg='red')
+
+    # batches are written and indexed in parallel, each write worker has
+    # its own database session; the output file has a single writer
+    pipeline = Pipeline([
+        Stage('write', write, workers=workers),
+        Stage('index', index, workers=workers),
+        Stage('output', write_output)
+    ], queue_size=2 * workers, on_error=on_error)
+    with progress:
+        stats = pipeline.run(chunks(enumerate(file_data, 1), batch_size))
+    if stats['write']['errors'] or stats['index']['errors']:
+        click.secho(
+            f'Failed batches: write {stats["write"]["errors"]} '
+            f'index {stats["index"]["errors"]}', fg='red')
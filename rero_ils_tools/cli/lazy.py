@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""RERO ILS Tools lazy command group."""
+
+from importlib import import_module
+
+import click
+
+
+class LazyGroup(click.Group):
+    """Group importing the module of a command only when it is invoked.
+
+    Commands are registered by dotted path with their short help, so
+    listing the commands of the group does not import anything.
+    """
+
+    def __init__(self, *args, lazy_subcommands=None, **kwargs):
+        """Constructor.
+
+        :param lazy_subcommands: dictionary of (`module:attribute`, short
+                                 help) by command name, relative modules
+                                 are resolved from `rero_ils_tools`.
+        """
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx):
+        """List the loaded and the lazy commands."""
+        return sorted(set(super().list_commands(ctx)) |
+                      set(self.lazy_subcommands))
+
+    def get_command(self, ctx, cmd_name):
+        """Get a command, importing its module if needed."""
+        if cmd_name not in self.commands and \
+                cmd_name in self.lazy_subcommands:
+            self.add_command(self._load(cmd_name), cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(self, ctx, formatter):
+        """Write the commands with their short help without importing."""
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in self.commands:
+                command = self.commands[name]
+                if command.hidden:
+                    continue
+                short_help = command.get_short_help_str(
+                    formatter.width - 6 - len(name))
+            else:
+                short_help = self.lazy_subcommands[name][1]
+            rows.append((name, short_help))
+        if rows:
+            with formatter.section('Commands'):
+                formatter.write_dl(rows)
+
+    def _load(self, cmd_name):
+        """Import a lazy command."""
+        path, _ = self.lazy_subcommands[cmd_name]
+        module_name, attribute = path.split(':')
+        module = import_module(module_name, package='rero_ils_tools')
+        command = getattr(module, attribute)
+        if not isinstance(command, click.Command):
+            raise ValueError(f'{path} is not a click command.')
+        return command
@@ -20,55 +20,130 @@
 
 from __future__ import absolute_import, print_function
 
-import json
 import os
 
 import click
-from flask import current_app
 from flask.cli import with_appcontext
-from rero_ils.modules.templates.api import Template
-from rero_ils.modules.utils import JsonWriter
+from invenio_db import db
+from rero_ils.modules.utils import (JsonWriter,
+                                    get_record_class_from_schema_or_pid_type)
+
+from ...indexing import indexing_controller
+from ...utils import chunks, fields_remover
+
+TEMPLATE_FIELDS_TO_REMOVE = {
+    'items': ['pid', 'barcode', 'status', 'document', 'holding',
+              'organisation', 'library'],
+    'holdings': ['pid', 'organisation', 'library', 'document'],
+    'patrons': ['pid', 'user_id', 'patron.subscriptions'],
+    'documents': ['pid'],
+}
+
+
+def template_cleaner(rules):
+    """Build a cleaner removing fields from the data of templates.
+
+    :param rules: dictionary of dotted paths to remove by template type.
+    :returns: function taking a template and returning True if it changed.
+    """
+    removers = {
+        template_type: fields_remover(paths)
+        for template_type, paths in rules.items()
+    }
+
+    def clean(template):
+        remover = removers.get(template.get('template_type'))
+        if remover and isinstance(template.get('data'), dict):
+            return remover(template['data'])
+        return False
+    return clean
+
+
+def clean_records(record_class, record_type, cleaner, batch_size, out_file,
+                  verbose):
+    """Clean records by batches.
+
+    Records are loaded and committed by batches, the cleaned records of
+    a batch are indexed by the indexing controller after its commit.
+
+    :param record_class: class of the records to clean.
+    :param record_type: record type as in RECORDS_REST_ENDPOINTS.
+    :param cleaner: function cleaning a record in place, returns True if
+                    the record changed.
+    :param batch_size: number of records per batch.
+    :param out_file: JsonWriter to backup records before changes.
+    :param verbose: verbose print.
+    :returns: the number of cleaned records.
+    """
+    count = 0
+    for ids in chunks(record_class.get_all_ids(), batch_size):
+        cleaned_ids = []
+        for record in record_class.get_records(ids):
+            if out_file:
+                out_file.write(record)
+            if not cleaner(record):
+                continue
+            if verbose:
+                click.secho(
+                    f'     cleaning {record_type} : {record.pid} '
+                    f'{record.get("name", "")}', fg='green')
+            try:
+                record.update(record, dbcommit=False, reindex=False)
+                record.commit()
+                cleaned_ids.append(record.id)
+            except Exception as err:
+                text = f'unable to clean {record_type} pid: {record.pid} {err}'
+                click.secho(text, fg='red')
+        db.session.commit()
+        if cleaned_ids:
+            indexing_controller().index(cleaned_ids, record_type)
+            count += len(cleaned_ids)
+    return count
 
 
 @click.command('clean_templates')
 @click.option('-o', '--output', 'output', help='backup json file.')
+@click.option('-t', '--record_type', 'record_type', default='tmpl',
+              help='record type as in RECORDS_REST_ENDPOINTS.')
+@click.option('-f', '--field', 'fields', multiple=True,
+              help='dotted path of a field to remove (non template types).')
+@click.option('-b', '--batch_size', 'batch_size', type=int, default=1000,
+              help='number of records per commit.')
+@click.option('-v', '--verbose', 'verbose', is_flag=True, default=False)
 @with_appcontext
-def clean_templates(output):
+def clean_templates(output, record_type, fields, batch_size, verbose):
     """Remove from templates unwanted fields in the data dictionary.
 
-    :param output: save backup of templates before updates.    
+    For other record types the given fields are removed from the records.
+
+    :param output: save backup of records before updates.
+    :param record_type: record type as in RECORDS_REST_ENDPOINTS.
+    :param fields: dotted paths of the fields to remove.
+    :param batch_size: number of records per commit.
+    :param verbose: print cleaned records.
     """
+    out_file = None
     if output:
         name, ext = os.path.splitext(output)
         out_file_name = f'{name}_output{ext}'
         out_file = JsonWriter(out_file_name)
 
-    fields_to_remove = {
-        'items': ['pid', 'barcode', 'status', 'document', 'holding',
-                  'organisation', 'library'],
-        'holdings': ['pid', 'organisation', 'library', 'document'],
-        'patrons': ['pid', 'user_id', 'patron.subscriptions'],
-        'documents': ['pid'],
-    }
-    click.secho(f'Start clean up of current templates...', fg='green')
-    pids = [pid for pid in Template.get_all_pids()]
-    click.secho(f'   number of templates to clean: {len(pids)}', fg='green')
-    for pid in pids:
-        template = Template.get_record_by_pid(pid)
-        out_file.write(template)
-        template_type = template.get('template_type')
-        fields = fields_to_remove.get(template_type, [])
-        for field in fields:
-            if '.' in field:
-                level_1, level_2 = field.split('.')
-                template.get('data', {}).get(level_1, {}).pop(level_2, None)
-            else:
-                template.get('data', {}).pop(field, None)
-        if fields:
-            click.secho(
-                f'     cleaning template : {template.get("name")}', fg='green')
-            try:
-                template.update(template, dbcommit=True, reindex=True)
-            except Exception as err:
-                text = f'unable to clean template pid: {pid} {err}'
-                click.secho(text, fg='red')
+    record_class = get_record_class_from_schema_or_pid_type(
+        pid_type=record_type)
+    if not record_class:
+        click.secho(f'Invalid record type: {record_type}', fg='red')
+        exit()
+    if record_type == 'tmpl':
+        cleaner = template_cleaner(TEMPLATE_FIELDS_TO_REMOVE)
+    elif fields:
+        cleaner = fields_remover(fields)
+    else:
+        click.secho(f'No fields to remove for: {record_type}', fg='red')
+        exit()
+
+    click.secho(f'Start clean up of current {record_type}...', fg='green')
+    click.secho(
+        f'   number of records: {record_class.count()}', fg='green')
+    count = clean_records(
+        record_class, record_type, cleaner, batch_size, out_file, verbose)
+    click.secho(f'   number of cleaned records: {count}', fg='green')
@@ -25,6 +25,8 @@ from flask import current_app
 from flask.cli import with_appcontext
 from rero_ils.modules.patrons.api import Patron
 
+from ...api import fetch_many
+
 
 @click.command('duplicate_emails')
 @click.option('-v', '--verbose', 'verbose', is_flag=True, default=False)
@@ -44,8 +46,7 @@ def duplicate_emails(verbose):
             duplicate_emails.append(email)
 
     all_user_ids = []
-    for pid in Patron.get_all_pids():
-        patron = Patron.get_record_by_pid(pid)
+    for _, patron in fetch_many(Patron, Patron.get_all_pids()):
         all_user_ids.append(patron.get('user_id'))
 
     emails = []
@@ -58,8 +59,7 @@ def duplicate_emails(verbose):
         if email:
             check_email(email, emails, duplicate_emails)
 
-    for pid in Patron.get_all_pids():
-        patron = Patron.get_record_by_pid(pid)
+    for _, patron in fetch_many(Patron, Patron.get_all_pids()):
         add_email = patron.patron.get('additional_communication_email')
         if add_email:
             check_email(email, emails, duplicate_add_emails)
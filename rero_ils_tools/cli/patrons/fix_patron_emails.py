@@ -29,6 +29,9 @@ from rero_ils.modules.patrons.api import Patron, PatronsSearch
 from rero_ils.modules.users.api import User
 from rero_ils.modules.utils import JsonWriter
 
+from ...api import fetch_many
+from ...progress import ProgressReporter
+
 
 @click.command('fix_patron_emails')
 @click.option('-v', '--verbose', 'verbose', is_flag=True, default=False)
@@ -41,18 +44,21 @@ def fix_patron_emails(verbose):
     click.secho(f'Fixing patron emails', fg='green')
     
     out_file = JsonWriter('list_patrons_with_emails_to_fix.json')
+    progress = ProgressReporter(
+        'patrons', total=PatronsSearch().count(),
+        log_file='fix_patron_emails_log.txt' if verbose else None)
 
-    
-    for pid in Patron.get_all_pids():
-        patron = Patron.get_record_by_pid(pid)
+    for pid, patron in fetch_many(Patron, Patron.get_all_pids()):
+        progress.advance()
         if patron:
             user_id = patron.get('user_id')
-            print('user_id: ', user_id)
+            progress.log(f'user_id: {user_id}')
             user = User.get_by_id(user_id)
             try:
                 data = user.dumpsMetadata()
                 email = data.get('email')
                 if email and email[-1].isdigit():
+                    progress.advance(0, fixed=1)
                     out_file.write(data)
                     data['email'] = None
                     if not data.get('keep_history'):
@@ -62,8 +68,9 @@ def fix_patron_emails(verbose):
                         if patron.get('patron') and not patron.get(
                             'patron', {}).get('additional_communication_email'):
                             patron['patron']['additional_communication_email'] = email.rstrip(string.digits)
-                            print('patron_pid: ', patron.pid)
+                            progress.log(f'patron_pid: {patron.pid}')
                             patron.update(patron, dbcommit=True, reindex=True)
             except Exception as err:
-                click.echo(err)
-                click.echo(f'ERROR: Can not extract record pid:{pid}')
+                progress.advance(0, errors=1)
+                progress.log(f'ERROR: Can not extract record pid:{pid} {err}')
+    progress.close()
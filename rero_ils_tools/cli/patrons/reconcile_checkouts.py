@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""RERO ILS item status and loans reconciliation command line interface."""
+
+from __future__ import absolute_import, print_function
+
+import click
+from flask.cli import with_appcontext
+from invenio_db import db
+from rero_ils.modules.items.api import Item, ItemsSearch
+from rero_ils.modules.loans.api import LoansSearch
+from rero_ils.modules.loans.models import LoanState
+from rero_ils.modules.utils import JsonWriter
+
+from ...api import fetch_many
+from ...indexing import indexing_controller
+from ...utils import chunks, sorted_difference, sorted_pids
+
+
+def on_loan_item_pids(org_pid):
+    """Item pids with an active checkout in the loans index.
+
+    :param org_pid: organisation pid.
+    :returns: sorted array of item pids.
+    """
+    query = LoansSearch() \
+        .filter('term', state=LoanState.ITEM_ON_LOAN) \
+        .filter('term', organisation__pid=org_pid) \
+        .source(['item_pid'])
+    return sorted_pids(hit.item_pid.value for hit in query.scan())
+
+
+def on_loan_status_item_pids(org_pid):
+    """Item pids with the on_loan status in the items index.
+
+    :param org_pid: organisation pid.
+    :returns: sorted array of item pids.
+    """
+    query = ItemsSearch() \
+        .filter('term', status='on_loan') \
+        .filter('term', organisation__pid=org_pid) \
+        .source(['pid'])
+    return sorted_pids(hit.pid for hit in query.scan())
+
+
+def repair_items(item_pids, repair, batch_size, update, out_file, verbose):
+    """Repair the status of the given items by batches.
+
+    :param item_pids: iterable of item pids to repair.
+    :param repair: function changing the status of an item in place.
+    :param batch_size: number of items per commit and bulk indexing.
+    :param update: really update the records.
+    :param out_file: JsonWriter to backup items before change.
+    :param verbose: verbose print.
+    :returns: number of repaired items.
+    """
+    count = 0
+    for batch in chunks(item_pids, batch_size):
+        ids = []
+        for _, item in fetch_many(Item, map(str, batch), batch_size):
+            if not item:
+                continue
+            if out_file:
+                out_file.write(item)
+            old_status = item.get('status')
+            if update:
+                try:
+                    repair(item)
+                    ids.append(item.id)
+                except Exception as err:
+                    click.secho(
+                        f'unable to repair item pid {item.pid} {err}',
+                        fg='red')
+                    continue
+            count += 1
+            if verbose:
+                click.echo(
+                    f'\titem pid: {item.pid} status: {old_status} -> '
+                    f'{item.get("status")}')
+        if ids:
+            db.session.commit()
+            indexing_controller().index(ids, 'item')
+    return count
+
+
+def set_on_loan(item):
+    """Set the on_loan status on an item with an active checkout."""
+    item['status'] = 'on_loan'
+    item.update(item, dbcommit=False, reindex=False)
+
+
+def reset_status(item):
+    """Recompute the status of an item without active checkout."""
+    Item.status_update(item, dbcommit=False, reindex=False)
+
+
+@click.command('reconcile_checkouts')
+@click.option('-g', '--org_pid', 'org_pid', required=True,
+              help='Organisation PID.')
+@click.option('-b', '--batch_size', 'batch_size', type=int, default=1000,
+              help='Number of items per commit.')
+@click.option('-o', '--output', 'output',
+              help='Backup JSON file of items before repair.')
+@click.option('-u', '--update', 'update', is_flag=True, default=False,
+              help='Really update records.')
+@click.option('-v', '--verbose', 'verbose', is_flag=True, default=False)
+@with_appcontext
+def reconcile_checkouts(org_pid, batch_size, output, update, verbose):
+    """Reconcile items status with active loans of an organisation.
+
+    :param org_pid: organisation pid.
+    :param batch_size: number of items per commit and bulk indexing.
+    :param output: backup of items before repair.
+    :param update: really update records.
+    :param verbose: verbose
+    """
+    click.secho(
+        f'Reconcile items status with loans for organisation: {org_pid}',
+        fg='green')
+    out_file = JsonWriter(output) if output else None
+
+    loaned_pids = on_loan_item_pids(org_pid)
+    status_pids = on_loan_status_item_pids(org_pid)
+    click.secho(
+        f'   active checkouts: {len(loaned_pids)} '
+        f'items on_loan: {len(status_pids)}', fg='green')
+
+    click.secho('Items on loan without on_loan status', fg='yellow')
+    missing_status = repair_items(
+        sorted_difference(loaned_pids, status_pids), set_on_loan,
+        batch_size, update, out_file, verbose)
+    click.secho('Items with on_loan status without active loan', fg='yellow')
+    stale_status = repair_items(
+        sorted_difference(status_pids, loaned_pids), reset_status,
+        batch_size, update, out_file, verbose)
+
+    click.secho(
+        f'Missing on_loan: {missing_status}, '
+        f'Stale on_loan: {stale_status}', fg='green')
@@ -21,48 +21,77 @@
 from __future__ import absolute_import, print_function
 
 import json
-import string
+import os
 
 import click
 from flask import current_app
 from flask.cli import with_appcontext
+from invenio_db import db
 from rero_ils.modules.items.api import Item
-from rero_ils.modules.utils import JsonWriter, extracted_data_from_ref
+
+from ...indexing import indexing_controller
+from ...progress import ProgressReporter
+from ...utils import key_from_path
+from ...writers import PartitionedJsonWriter
 
 
 @click.command('validate_checkouts')
 @click.option('-v', '--verbose', 'verbose', is_flag=True, default=False)
 @click.option('-i', '--infile', 'infile', required=True)
+@click.option('-k', '--key', 'key', default='organisation',
+              help='Dotted path of the field used to split the output.')
+@click.option('-o', '--output', 'output',
+              default='virtua_transactions_not_yet_loaded_{key}.json',
+              help='Output file name pattern with a {key} placeholder.')
+@click.option('-b', '--batch_size', 'batch_size', type=int, default=1000,
+              help='Number of fixed items per commit and bulk indexing.')
 @with_appcontext
-def validate_checkouts(infile, verbose):
+def validate_checkouts(infile, key, output, batch_size, verbose):
     """Valide Virtua checkouts.
 
     :param infile: file with Virtua circulation transactions
+    :param key: field used to split the transactions not yet loaded
+    :param output: output file name pattern
+    :param batch_size: number of fixed items per commit and bulk indexing
     :param verbose: verbose
     """
     click.secho(f'Validating Virtua checkouts', fg='green')
-    
-    vs_file = JsonWriter('virtua_transactions_not_yet_loaded_vs.json')
-    bulle_file = JsonWriter('virtua_transactions_not_yet_loaded_bulle.json')
-    nj_file = JsonWriter('virtua_transactions_not_yet_loaded_nj.json')
-    with open(infile) as infile_filename:
+
+    with open(infile) as infile_filename, \
+            PartitionedJsonWriter(output, key_from_path(key)) as out_files:
         transactions = json.load(infile_filename)
+        progress = ProgressReporter(
+            'transactions', total=len(transactions),
+            log_file=f'{os.path.splitext(infile)[0]}_log.txt'
+            if verbose else None)
+        ids = []
         for transaction in transactions:
             item_pid = transaction.get('item_pid')
-            print('item_pid', item_pid)
-            on_loan_loan = Item.get_loan_pid_with_item_on_loan(item_pid) 
+            progress.log(f'item_pid {item_pid}')
+            on_loan_loan = Item.get_loan_pid_with_item_on_loan(item_pid)
             if on_loan_loan:
                 item = Item.get_record_by_pid(item_pid)
                 if item.get('status') != 'on_loan':
-                    print('missing on_loan status')
+                    progress.log(f'item_pid {item_pid} missing on_loan status')
+                    progress.advance(0, fixed=1)
                     item['status'] = 'on_loan'
-                    item.update(item, dbcommit=True, reindex=True)
+                    new_item = item.update(
+                        item, dbcommit=False, reindex=False)
+                    new_item.commit()
+                    ids.append(new_item.id)
             else:
-                org_pid = extracted_data_from_ref(
-                    transaction.get('organisation').get('$ref'))
-                if int(org_pid) == 1:
-                    bulle_file.write(transaction)
-                elif int(org_pid) == 2:
-                    vs_file.write(transaction)
-                elif int(org_pid) == 3:
-                    nj_file.write(transaction)
+                out_files.write(transaction)
+                progress.advance(0, not_loaded=1)
+            progress.advance()
+            if len(ids) >= batch_size:
+                db.session.commit()
+                indexing_controller().index(ids, 'item')
+                ids = []
+        if ids:
+            db.session.commit()
+            indexing_controller().index(ids, 'item')
+        progress.close()
+    for partition, count in sorted(out_files.counts().items(), key=str):
+        click.secho(
+            f'   {key} {partition}: {count} transactions not yet loaded',
+            fg='yellow')
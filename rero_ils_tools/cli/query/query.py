@@ -32,6 +32,8 @@ from rero_ils.modules.utils import (JsonWriter,
                                     get_record_class_from_schema_or_pid_type,
                                     read_json_record)
 
+from ...api import fetch_many, search_pids
+
 
 @click.command('query')
 @click.option('-v', '--verbose', 'verbose', is_flag=True, default=False)
@@ -79,10 +81,14 @@ def records_query(infile, full, model, record_type, output, verbose):
         'query_string', query=expert_search).source('pid')
     click.secho(f'Number of records to extract: {search.count()}', fg='green')
 
-    for count, hit in enumerate(search.scan(), 1):
+    records = fetch_many(record_class, search_pids(search))
+    for count, (pid, record) in enumerate(records, 1):
+        if record is None:
+            # deleted since the search
+            click.secho(
+                f'{count: <8} record pid:{pid} not found', fg='yellow')
+            continue
         try:
-            pid = hit.pid
-            record = record_class.get_record_by_pid(pid)
             if verbose:
                 click.echo(
                     f'{count: <8} extract record {record.pid}:{record.id}')
@@ -27,13 +27,15 @@ import click
 from flask import current_app
 from flask.cli import with_appcontext
 from invenio_db import db
-from rero_ils.modules.api import IlsRecordsIndexer
 from rero_ils.modules.item_types.api import ItemType
 from rero_ils.modules.tasks import process_bulk_queue
 from rero_ils.modules.utils import (JsonWriter,
                                     get_record_class_from_schema_or_pid_type,
                                     get_ref_for_pid, read_json_record)
 
+from ...api import fetch_many
+from ...indexing import indexing_controller
+
 
 @click.command('set_circulation_category')
 @click.option('-l', '--lazy', 'lazy', is_flag=True, default=False)
@@ -81,18 +83,25 @@ def set_circulation_category(
         pid_type=record_type)
 
     ids = []
-    for counter, record in enumerate(file_data, 1):
-        record_pid = record.get('pid')
-        new_circ_category = record.get('new_circulation_category_pid')
+    # records are loaded from the database by chunks, the few item types
+    # only once
+    item_types = {}
+    records = fetch_many(
+        record_class, file_data, key=lambda data: data.get('pid'))
+    for counter, (data, record) in enumerate(records, 1):
+        record_pid = data.get('pid')
+        new_circ_category = data.get('new_circulation_category_pid')
 
         if not record_pid or not new_circ_category:
             click.secho(f'record # {counter} missing fields', fg='red')
             if save_errors:
-                error_file.write(record)
+                error_file.write(data)
             continue
 
-        record = record_class.get_record_by_pid(record_pid)
-        itty = ItemType.get_record_by_pid(new_circ_category)
+        if new_circ_category not in item_types:
+            item_types[new_circ_category] = ItemType.get_record_by_pid(
+                new_circ_category)
+        itty = item_types[new_circ_category]
         # we do not modify circulation category if:
         # item is not in database
         # invalid new new_circ_category
@@ -103,7 +112,7 @@ def set_circulation_category(
             click.secho(
                 f'unable to modify rec # {counter} pid {record_pid}', fg='red')
             if save_errors:
-                error_file.write(record)
+                error_file.write(data)
             continue
 
         try:
@@ -122,12 +131,12 @@ def set_circulation_category(
             text = f'record# {counter} pid {record_pid} failed creation {err}'
             click.secho(text, fg='red')
             if save_errors:
-                error_file.write(record)
+                error_file.write(data)
         # TODO: create a separate loop for indexing and commits
         if counter % 1000 == 0:
             db.session.commit()
-            IlsRecordsIndexer().bulk_index(ids, doc_type=record_type)
+            indexing_controller().index(ids, record_type)
             ids = []
     if ids:
         db.session.commit()
-        IlsRecordsIndexer().bulk_index(ids, doc_type=record_type)
+        indexing_controller().index(ids, record_type)
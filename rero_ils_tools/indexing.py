@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""RERO ILS Tools indexing controller.
+
+All the bulk requests of the commands go through one controller per
+process, configured by the application:
+
+- TOOLS_INDEXING_MAX_RATE: maximum number of documents per second and per
+  process, no limit by default.
+- TOOLS_INDEXING_TARGET_LATENCY: bulk request time in seconds above which
+  the batches are reduced, 2 by default.
+- TOOLS_INDEXING_MIN_BATCH, TOOLS_INDEXING_MAX_BATCH: batch size limits,
+  50 and 2000 by default.
+- TOOLS_INDEXING_MAX_CONCURRENCY: maximum number of bulk requests running
+  at the same time in a process, 4 by default.
+
+As any invenio configuration, they can be set with `INVENIO_` prefixed
+environment variables.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app
+
+# controller of the process
+_controller = None
+_controller_lock = threading.Lock()
+
+
+class BulkRejected(Exception):
+    """Elasticsearch rejected documents of a bulk request."""
+
+
+def is_rejection(err):
+    """Check if an error is an elasticsearch overload rejection.
+
+    :param err: exception raised by a bulk request.
+    :returns: True for too many requests errors.
+    """
+    if isinstance(err, BulkRejected):
+        return True
+    if getattr(err, 'status_code', None) == 429:
+        return True
+    return bool(rejected_errors(getattr(err, 'errors', None) or []))
+
+
+def rejected_errors(errors):
+    """Select the rejected documents of bulk errors.
+
+    :param errors: list of errors returned by `elasticsearch.helpers.bulk`.
+    :returns: list of the errors with a too many requests status.
+    """
+    return [
+        error for error in errors
+        if isinstance(error, dict) and any(
+            isinstance(value, dict) and value.get('status') == 429
+            for value in error.values())
+    ]
+
+
+class IndexingController:
+    """Run bulk requests by batches adapted to the elasticsearch load.
+
+    The batch size and the concurrency follow an AIMD policy: after each
+    fast request the batch size grows by `increase` documents and one more
+    request may run at the same time, both are divided by two when a
+    request is slower than the target latency or when elasticsearch
+    rejects documents. The concurrency limits the requests of all the
+    threads sharing the controller, i.e. the workers of a pipeline stage.
+    Rejected batches are sent again after a backoff. The number of
+    documents per second never exceeds `max_rate`.
+    """
+
+    def __init__(self, max_rate=None, target_latency=2.0, min_batch=50,
+                 max_batch=2000, increase=50, max_retries=8, backoff=1.0,
+                 max_concurrency=4):
+        """Constructor.
+
+        :param max_rate: maximum number of documents per second.
+        :param target_latency: maximum time in seconds of a bulk request.
+        :param min_batch: minimum number of documents per request.
+        :param max_batch: maximum number of documents per request.
+        :param increase: batch size increment after a fast request.
+        :param max_retries: number of retries of a rejected batch.
+        :param backoff: first wait in seconds after a rejection, doubled
+                        at each retry.
+        :param max_concurrency: maximum number of requests running at the
+                                same time.
+        """
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.increase = increase
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_concurrency = max_concurrency
+        self.batch_size = max(min_batch, max_batch // 4)
+        self.concurrency = max_concurrency
+        self.running = 0
+        self.sent = 0
+        self.rejections = 0
+        self._next_time = time.monotonic()
+        self._lock = threading.Lock()
+        self._slots = threading.Condition(self._lock)
+
+    def bulk(self, items, func):
+        """Run a bulk function on adaptive batches of items.
+
+        :param items: list of items, i.e. record ids.
+        :param func: function sending one batch of items to elasticsearch,
+                     it raises an exception to signal rejections.
+        """
+        items = list(items)
+        position = 0
+        while position < len(items):
+            batch = items[position:position + self.batch_size]
+            self._send(batch, func)
+            position += len(batch)
+
+    def index(self, ids, doc_type):
+        """Index records by adaptive batches.
+
+        :param ids: list of record ids.
+        :param doc_type: pid type of the records.
+        """
+        from rero_ils.modules.api import IlsRecordsIndexer
+
+        def index_batch(batch):
+            indexer = IlsRecordsIndexer()
+            indexer.bulk_index(batch, doc_type=doc_type)
+            indexer.process_bulk_queue()
+        self.bulk([str(_id) for _id in ids], index_batch)
+
+    def _send(self, batch, func, retry=0):
+        """Send a batch, retrying it after the rejections.
+
+        A rejected batch is split to the decreased batch size before it is
+        sent again.
+        """
+        self._throttle(len(batch))
+        try:
+            with self._slot():
+                start = time.monotonic()
+                func(batch)
+                elapsed = time.monotonic() - start
+        except Exception as err:
+            if not is_rejection(err) or retry == self.max_retries:
+                raise
+            self._decrease(rejected=True)
+            time.sleep(self.backoff * 2 ** retry)
+            size = self.batch_size
+            for position in range(0, len(batch), size):
+                self._send(batch[position:position + size], func, retry + 1)
+            return
+        if elapsed > self.target_latency:
+            self._decrease()
+        else:
+            self._increase()
+        with self._lock:
+            self.sent += len(batch)
+
+    @contextmanager
+    def _slot(self):
+        """Wait until a request can run under the concurrency limit."""
+        with self._slots:
+            while self.running >= self.concurrency:
+                self._slots.wait()
+            self.running += 1
+        try:
+            yield
+        finally:
+            with self._slots:
+                self.running -= 1
+                self._slots.notify_all()
+
+    def _throttle(self, count):
+        """Wait to keep the number of documents per second under the max."""
+        if not self.max_rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_time - now
+            self._next_time = max(now, self._next_time) + \
+                count / self.max_rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def _increase(self):
+        """Additive increase of the batch size and of the concurrency."""
+        with self._slots:
+            self.batch_size = min(
+                self.max_batch, self.batch_size + self.increase)
+            self.concurrency = min(
+                self.max_concurrency, self.concurrency + 1)
+            self._slots.notify_all()
+
+    def _decrease(self, rejected=False):
+        """Multiplicative decrease of the batch size and concurrency."""
+        with self._lock:
+            if rejected:
+                self.rejections += 1
+            self.batch_size = max(self.min_batch, self.batch_size // 2)
+            self.concurrency = max(1, self.concurrency // 2)
+
+
+def indexing_controller():
+    """Get the indexing controller of the process.
+
+    :returns: the controller configured by the current application.
+    """
+    global _controller
+    with _controller_lock:
+        if _controller is None:
+            config = current_app.config
+            _controller = IndexingController(
+                max_rate=config.get('TOOLS_INDEXING_MAX_RATE'),
+                target_latency=config.get(
+                    'TOOLS_INDEXING_TARGET_LATENCY', 2.0),
+                min_batch=config.get('TOOLS_INDEXING_MIN_BATCH', 50),
+                max_batch=config.get('TOOLS_INDEXING_MAX_BATCH', 2000),
+                max_concurrency=config.get(
+                    'TOOLS_INDEXING_MAX_CONCURRENCY', 4))
+        return _controller
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""RERO ILS Tools performance instrumentation.
+
+Commands mark their phases and count their records with `phase` and
+`count_records`, which do nothing unless the profiler is started by the
+`--profile` option of the tools group.
+
+`--cprofile` and `--sample` of the tools_cli group profile any command
+with cProfile or with a stack sampler.
+"""
+
+import json
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+import click
+
+# running profiler
+_profiler = None
+
+
+class Profiler:
+    """Collect wall times, SQL statements and elasticsearch requests.
+
+    Only the current process is instrumented, the worker processes of a
+    pool are not.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.started = None
+        self.stopped = None
+        self.phases = {}
+        self.records = {}
+        self.sql = {'count': 0, 'time': 0.0}
+        self.es = {}
+        self._lock = threading.Lock()
+        self._active = threading.local()
+        self._perform_request = None
+
+    def start(self):
+        """Install the hooks and start the clock."""
+        self._listen_sql()
+        self._wrap_es()
+        self.started = time.perf_counter()
+
+    def stop(self):
+        """Stop the clock and remove the hooks."""
+        self.stopped = time.perf_counter()
+        self._listen_sql(remove=True)
+        self._unwrap_es()
+
+    @contextmanager
+    def phase(self, name):
+        """Measure the wall time of a phase, phases can be nested."""
+        stack = self._phase_stack()
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                phase = self.phases.setdefault(
+                    name, {'time': 0.0, 'calls': 0, 'records': 0})
+                phase['time'] += elapsed
+                phase['calls'] += 1
+
+    def count_records(self, count=1, name='records'):
+        """Count processed records, also for the running phases."""
+        with self._lock:
+            self.records[name] = self.records.get(name, 0) + count
+            for phase_name in self._phase_stack():
+                phase = self.phases.setdefault(
+                    phase_name, {'time': 0.0, 'calls': 0, 'records': 0})
+                phase['records'] += count
+
+    def summary(self):
+        """Summary of the measures.
+
+        :returns: dictionary ready to be dumped as JSON.
+        """
+        wall_time = (self.stopped or time.perf_counter()) - self.started
+        return {
+            'wall_time': wall_time,
+            'phases': {
+                name: {
+                    **phase,
+                    'records_per_second': phase['records'] / phase['time']
+                    if phase['time'] else 0
+                }
+                for name, phase in self.phases.items()
+            },
+            'records': {
+                name: {
+                    'count': count,
+                    'records_per_second': count / wall_time
+                    if wall_time else 0
+                }
+                for name, count in self.records.items()
+            },
+            'sql': dict(self.sql),
+            'es': {index: dict(values) for index, values in self.es.items()}
+        }
+
+    def report(self, output=None):
+        """Print the summary and optionally write it as JSON.
+
+        :param output: JSON file name.
+        """
+        summary = self.summary()
+        click.secho(
+            f'Profile: wall time {summary["wall_time"]:.2f}s', fg='blue',
+            err=True)
+        for name, phase in summary['phases'].items():
+            click.secho(
+                f'  phase {name}: {phase["time"]:.2f}s '
+                f'calls: {phase["calls"]} records: {phase["records"]} '
+                f'({phase["records_per_second"]:.1f}/s)', fg='blue', err=True)
+        for name, records in summary['records'].items():
+            click.secho(
+                f'  {name}: {records["count"]} '
+                f'({records["records_per_second"]:.1f}/s)', fg='blue',
+                err=True)
+        click.secho(
+            f'  sql: {summary["sql"]["count"]} statements '
+            f'{summary["sql"]["time"]:.2f}s', fg='blue', err=True)
+        for index, values in sorted(summary['es'].items()):
+            click.secho(
+                f'  es {index}: {values["count"]} requests '
+                f'{values["time"]:.2f}s', fg='blue', err=True)
+        if output:
+            with open(output, 'w') as out_file:
+                json.dump(summary, out_file, indent=2)
+
+    def _phase_stack(self):
+        """Running phases of the current thread."""
+        if not hasattr(self._active, 'stack'):
+            self._active.stack = []
+        return self._active.stack
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        """Start the clock of a SQL statement."""
+        conn.info.setdefault('profile_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        """Measure a SQL statement."""
+        elapsed = time.perf_counter() - conn.info['profile_start'].pop()
+        with self._lock:
+            self.sql['count'] += 1
+            self.sql['time'] += elapsed
+
+    def _listen_sql(self, remove=False):
+        """Listen to the statements of all the SQLAlchemy engines."""
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        action = event.remove if remove else event.listen
+        action(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        action(Engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _wrap_es(self):
+        """Measure the requests of all the elasticsearch clients."""
+        from elasticsearch import Transport
+        perform_request = self._perform_request = Transport.perform_request
+        profiler = self
+
+        @wraps(perform_request)
+        def wrapper(transport, method, url, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return perform_request(transport, method, url, *args,
+                                       **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                index = url.lstrip('/').split('/', 1)[0] or '/'
+                with profiler._lock:
+                    values = profiler.es.setdefault(
+                        index, {'count': 0, 'time': 0.0})
+                    values['count'] += 1
+                    values['time'] += elapsed
+
+        Transport.perform_request = wrapper
+
+    def _unwrap_es(self):
+        """Restore the elasticsearch requests."""
+        from elasticsearch import Transport
+        if self._perform_request:
+            Transport.perform_request = self._perform_request
+            self._perform_request = None
+
+
+def start_profiler():
+    """Start the profiler of the current command.
+
+    :returns: the started profiler.
+    """
+    global _profiler
+    _profiler = Profiler()
+    _profiler.start()
+    return _profiler
+
+
+def stop_profiler(output=None):
+    """Stop the profiler and report its measures.
+
+    :param output: JSON file name for the summary.
+    """
+    global _profiler
+    if _profiler:
+        _profiler.stop()
+        _profiler.report(output)
+        _profiler = None
+
+
+@contextmanager
+def phase(name):
+    """Measure a phase of a command if the profiler is running."""
+    if _profiler:
+        with _profiler.phase(name):
+            yield
+    else:
+        yield
+
+
+def count_records(count=1, name='records'):
+    """Count processed records if the profiler is running."""
+    if _profiler:
+        _profiler.count_records(count, name)
+
+
+def start_cprofile(output):
+    """Profile the current process with cProfile.
+
+    :param output: file for the statistics, readable with pstats or
+                   snakeviz.
+    :returns: function stopping the profiler and writing the statistics.
+    """
+    import cProfile
+    profile = cProfile.Profile()
+    profile.enable()
+
+    def stop():
+        profile.disable()
+        profile.dump_stats(output)
+        click.secho(f'cProfile statistics written to {output}', fg='blue',
+                    err=True)
+    return stop
+
+
+class StackSampler:
+    """Sample the stacks of all the threads at a fixed interval.
+
+    A wall clock timer signal interrupts the main thread, which records
+    the current stack of every thread. Threads waiting on a queue or on
+    the network are thus sampled in their waiting function. The stacks
+    are written in the folded format of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, output, interval=0.01):
+        """Constructor.
+
+        :param output: file for the folded stacks.
+        :param interval: sampling interval in seconds.
+        """
+        self.output = output
+        self.interval = interval
+        self.stacks = Counter()
+        self._handler = None
+
+    def start(self):
+        """Start the sampling timer."""
+        self._handler = signal.signal(signal.SIGALRM, self._sample)
+        signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+
+    def stop(self):
+        """Stop the sampling timer and write the folded stacks."""
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self._handler or signal.SIG_DFL)
+        with open(self.output, 'w') as out_file:
+            for stack, count in self.stacks.most_common():
+                out_file.write(f'{stack} {count}\n')
+        click.secho(
+            f'{sum(self.stacks.values())} stack samples written to '
+            f'{self.output}', fg='blue', err=True)
+
+    def _sample(self, signum, frame):
+        """Record the stacks of all the threads."""
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, thread_frame in sys._current_frames().items():
+            # the main thread is sampled where the signal interrupted it
+            if thread_id == threading.main_thread().ident:
+                thread_frame = frame
+            stack = []
+            while thread_frame is not None:
+                code = thread_frame.f_code
+                # functions are identified by their first line to merge
+                # the samples of a function
+                stack.append(f'{code.co_name} ({code.co_filename}:'
+                             f'{code.co_firstlineno})')
+                thread_frame = thread_frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            self.stacks[';'.join(reversed(stack))] += 1
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""RERO ILS Tools staged pipeline."""
+
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from multiprocessing import get_context
+from queue import Queue
+
+from flask import current_app, has_app_context
+
+from .instrumentation import phase
+from .pool import _call, _init_worker
+
+# end of the input of a stage worker
+_DONE = object()
+
+
+class Stage:
+    """A step of a pipeline.
+
+    The function of the stage is called for each item received from the
+    previous stage, its result is sent to the next stage unless it is
+    None.
+    """
+
+    def __init__(self, name, func, workers=1, processes=False):
+        """Constructor.
+
+        :param name: name of the stage, used in the errors and statistics.
+        :param func: function called for each item.
+        :param workers: number of parallel workers, with more than one
+                        worker the order of the items is not kept.
+        :param processes: run the function in worker processes, for CPU
+                          bound stages. The function and the items must be
+                          picklable, the function runs in the application
+                          context of its worker process.
+        """
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.processes = processes
+        self.received = 0
+        self.sent = 0
+        self.errors = 0
+
+
+class Pipeline:
+    """Run items through stages connected by bounded queues.
+
+    Each stage has its own worker threads, so I/O bound stages (database
+    writes, indexing, output files) run concurrently. The worker threads
+    run in an application context when an application is given or
+    available.
+    """
+
+    def __init__(self, stages, queue_size=2, on_error=None, app=None,
+                 create_app=None):
+        """Constructor.
+
+        :param stages: list of stages in processing order.
+        :param queue_size: maximum number of items waiting before a stage.
+        :param on_error: function called with the stage, the item and the
+                         exception when a stage fails for an item. It is
+                         called in the worker thread of the stage. The
+                         exception is raised at the end of the run if no
+                         function is given.
+        :param app: flask application for the worker threads, the current
+                    application by default.
+        :param create_app: application factory of the worker processes,
+                           the invenio one by default.
+        """
+        if create_app is None:
+            from . import create_app
+        self.stages = stages
+        self.queue_size = queue_size
+        self.on_error = on_error
+        self.app = app
+        self.create_app = create_app
+        self._lock = threading.Lock()
+        self._exception = None
+
+    def run(self, items):
+        """Run the items through the stages.
+
+        :param items: iterable of items sent to the first stage.
+        :returns: statistics of the stages, see `stats`.
+        """
+        app = self.app
+        if app is None and has_app_context():
+            app = current_app._get_current_object()
+        queues = [Queue(self.queue_size) for _ in self.stages]
+        queues.append(None)
+        threads = []
+        executors = []
+        for index, stage in enumerate(self.stages):
+            executor = None
+            if stage.processes:
+                # the worker threads of the other stages hold connections
+                # and locks, the worker processes are not forked
+                executor = ProcessPoolExecutor(
+                    max_workers=stage.workers,
+                    mp_context=get_context('spawn'),
+                    initializer=_init_worker, initargs=(self.create_app,))
+                executors.append(executor)
+            workers = [
+                threading.Thread(
+                    target=self._work,
+                    args=(stage, app, executor, queues[index],
+                          queues[index + 1]),
+                    name=f'{stage.name}-{number}', daemon=True)
+                for number in range(stage.workers)
+            ]
+            for worker in workers:
+                worker.start()
+            closer = threading.Thread(
+                target=self._close,
+                args=(workers, queues[index + 1], index + 1),
+                daemon=True)
+            closer.start()
+            threads.append(closer)
+        try:
+            for item in items:
+                queues[0].put(item)
+        finally:
+            for _ in range(self.stages[0].workers):
+                queues[0].put(_DONE)
+            for thread in threads:
+                thread.join()
+            for executor in executors:
+                executor.shutdown()
+        if self._exception:
+            raise self._exception
+        return self.stats()
+
+    def stats(self):
+        """Statistics of the stages.
+
+        :returns: dictionary of received, sent and failed items counts by
+                  stage name.
+        """
+        return {
+            stage.name: {
+                'received': stage.received,
+                'sent': stage.sent,
+                'errors': stage.errors
+            }
+            for stage in self.stages
+        }
+
+    def _close(self, workers, out_queue, next_index):
+        """Signal the end of the input to the next stage."""
+        for worker in workers:
+            worker.join()
+        if out_queue is not None:
+            for _ in range(self.stages[next_index].workers):
+                out_queue.put(_DONE)
+
+    def _work(self, stage, app, executor, in_queue, out_queue):
+        """Process the items of a stage until the end of its input."""
+        with app.app_context() if app else nullcontext():
+            while True:
+                item = in_queue.get()
+                if item is _DONE:
+                    return
+                with self._lock:
+                    stage.received += 1
+                try:
+                    with phase(stage.name):
+                        if executor:
+                            result = executor.submit(
+                                _call, stage.func, item).result()
+                        else:
+                            result = stage.func(item)
+                except Exception as err:
+                    with self._lock:
+                        stage.errors += 1
+                    self._error(stage, item, err)
+                    continue
+                if result is None:
+                    continue
+                with self._lock:
+                    stage.sent += 1
+                if out_queue is not None:
+                    out_queue.put(result)
+
+    def _error(self, stage, item, err):
+        """Route the error of a stage."""
+        if self.on_error:
+            try:
+                self.on_error(stage, item, err)
+                return
+            except Exception as handler_err:
+                err = handler_err
+        with self._lock:
+            if self._exception is None:
+                self._exception = err
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""RERO ILS Tools worker processes pool."""
+
+import traceback
+from collections import Counter
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                as_completed, wait)
+from multiprocessing import get_context
+
+from .utils import chunks
+
+# application of the worker process
+_app = None
+
+
+def _init_worker(create_app):
+    """Create the application of a worker process once."""
+    global _app
+    _app = create_app()
+
+
+def _call(func, item):
+    """Call a function in the application context of the worker."""
+    with _app.app_context():
+        return func(item)
+
+
+def _run(func, chunk):
+    """Run a function on a chunk in the application context.
+
+    Errors are returned as text as they may not be picklable.
+    """
+    try:
+        with _app.app_context():
+            return func(chunk), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+class WorkerPool:
+    """Process chunks of work in worker processes.
+
+    Every worker process creates its own application, and thus its own
+    database and elasticsearch connections, and runs the functions in its
+    application context. The functions and the items must be picklable:
+    use module functions, `functools.partial` for extra arguments, and
+    send pids or JSON data instead of records.
+    """
+
+    def __init__(self, workers=2, chunk_size=1000, create_app=None):
+        """Constructor.
+
+        :param workers: number of worker processes.
+        :param chunk_size: number of items sent to a worker at once.
+        :param create_app: application factory, the invenio one by
+                           default.
+        """
+        if create_app is None:
+            from . import create_app
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.create_app = create_app
+        self.errors = []
+
+    def map(self, func, items):
+        """Run a function on the chunks of the items.
+
+        At most two chunks per worker are pending, so the items can be
+        streamed.
+
+        :param func: function called with a list of items.
+        :param items: iterable of items.
+        :returns: generator of (chunk, result, error) in completion order,
+                  the error is the formatted traceback or None.
+        """
+        with ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self.create_app,)) as executor:
+            futures = {}
+            for chunk in chunks(items, self.chunk_size):
+                futures[executor.submit(_run, func, chunk)] = chunk
+                if len(futures) >= 2 * self.workers:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield self._result(futures.pop(future), future)
+            for future in as_completed(futures):
+                yield self._result(futures[future], future)
+
+    def run(self, func, items):
+        """Run a function returning counters on the chunks of the items.
+
+        :param func: function called with a list of items and returning a
+                     dictionary of counts.
+        :param items: iterable of items.
+        :returns: the sum of the counts.
+        """
+        counters = Counter()
+        for _, result, _ in self.map(func, items):
+            if result:
+                counters.update(result)
+        return counters
+
+    def _result(self, chunk, future):
+        """Get the result of a chunk and keep its error."""
+        result, error = future.result()
+        if error:
+            self.errors.append((chunk, error))
+        return chunk, result, error
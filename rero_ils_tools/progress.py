@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""RERO ILS Tools progress reporting."""
+
+import threading
+import time
+from datetime import timedelta
+
+import click
+
+
+class ProgressReporter:
+    """Report the progress of a command at a fixed interval.
+
+    One line with the counters, the rate and the estimated remaining time
+    is printed at most every `interval` seconds instead of one line per
+    record. Per record messages are only written to a buffered log file.
+    """
+
+    def __init__(self, label, total=None, interval=10, log_file=None,
+                 buffer_size=1000):
+        """Constructor.
+
+        :param label: name of the processed records.
+        :param total: number of records to process, if known.
+        :param interval: minimum number of seconds between two reports.
+        :param log_file: file name for the per record messages, they are
+                         discarded if not given.
+        :param buffer_size: number of messages kept before a log write.
+        """
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.buffer_size = buffer_size
+        self.count = 0
+        self.counters = {}
+        self.started = time.perf_counter()
+        self._reported = self.started
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._log = open(log_file, 'w') if log_file else None
+        self._closed = False
+
+    def __enter__(self):
+        """Context manager enter."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Context manager exit."""
+        self.close()
+
+    def advance(self, count=1, **counters):
+        """Count processed records.
+
+        :param count: number of processed records.
+        :param counters: increments of named counters, i.e. errors=1.
+        """
+        with self._lock:
+            self.count += count
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            now = time.perf_counter()
+            if now - self._reported < self.interval:
+                return
+            self._reported = now
+        self.report()
+
+    def log(self, msg):
+        """Write a per record message to the log file."""
+        if self._log is None:
+            return
+        with self._lock:
+            self._buffer.append(msg)
+            if len(self._buffer) < self.buffer_size:
+                return
+            self._flush()
+
+    def report(self, final=False):
+        """Print the counters, the rate and the remaining time."""
+        elapsed = time.perf_counter() - self.started
+        rate = self.count / elapsed if elapsed else 0
+        done = f'{self.count}'
+        eta = ''
+        if self.total:
+            done = f'{self.count}/{self.total} ' \
+                f'({100 * self.count / self.total:.1f}%)'
+            if rate and not final:
+                remaining = (self.total - self.count) / rate
+                eta = f' ETA {timedelta(seconds=round(remaining))}'
+        counters = ''.join(
+            f' {name}: {value}' for name, value in self.counters.items())
+        elapsed = timedelta(seconds=round(elapsed))
+        click.secho(
+            f'{self.label}: {done} {rate:.1f}/s{eta}{counters} '
+            f'[{elapsed}]', fg='green' if final else None)
+
+    def close(self):
+        """Print the final report and close the log file."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._log is not None:
+            with self._lock:
+                self._flush()
+            self._log.close()
+        self.report(final=True)
+
+    def _flush(self):
+        """Write the buffered messages, the lock must be held."""
+        if self._buffer:
+            self._log.write('\n'.join(self._buffer) + '\n')
+            self._buffer = []
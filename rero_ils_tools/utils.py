@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""RERO ILS Tools utilities."""
+
+import re
+from array import array
+from functools import lru_cache
+from itertools import islice
+
+# a subfield of a local field value: $<code><text>, a $ not followed by a
+# code is part of the text
+SUBFIELD_REGEX = re.compile(r'\$(\w)([^$]*(?:\$(?!\w)[^$]*)*)')
+
+
+def chunks(iterable, size):
+    """Split an iterable into lists of at most size elements.
+
+    :param iterable: values to split.
+    :param size: maximum length of a chunk.
+    :returns: generator of lists.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def sorted_pids(pids):
+    """Build a compact sorted array of unique numeric pids.
+
+    Pids which are not numbers, or which would change as numbers (i.e.
+    leading zeros), can not be stored in the array: the pids are then
+    returned as a sorted list of unique strings.
+
+    :param pids: iterable of pids (str or int).
+    :returns: sorted array of unsigned 64 bits integers, or sorted list of
+              strings.
+    """
+    pids = {str(pid) for pid in pids}
+    try:
+        values = sorted(int(pid) for pid in pids if str(int(pid)) == pid)
+        if len(values) == len(pids):
+            return array('Q', values)
+    except (ValueError, OverflowError):
+        pass
+    return sorted(pids)
+
+
+def sorted_difference(left, right):
+    """Values of the sorted array left missing in the sorted array right.
+
+    Both arrays have to be sorted, a value repeated in left is returned
+    once. Numeric and string pids built by `sorted_pids` are compared as
+    strings.
+
+    :param left: sorted array.
+    :param right: sorted array.
+    :returns: generator of values.
+    """
+    if isinstance(left, array) != isinstance(right, array):
+        left, right = sorted(map(str, left)), sorted(map(str, right))
+    idx, size = 0, len(right)
+    previous = None
+    for value in left:
+        if value == previous:
+            continue
+        previous = value
+        while idx < size and right[idx] < value:
+            idx += 1
+        if idx >= size or right[idx] != value:
+            yield value
+
+
+@lru_cache(maxsize=4096)
+def pid_from_ref(ref):
+    """Extract the pid from a `$ref` URL.
+
+    :param ref: reference URL, i.e. https://bib.rero.ch/api/items/1
+    :returns: the pid of the referenced record.
+    """
+    return ref.rstrip('/').rsplit('/', 1)[-1]
+
+
+def key_from_path(path):
+    """Build a function returning the value of a dotted path of a record.
+
+    Values linked with a `$ref` are resolved to the referenced pid.
+
+    :param path: dotted path, i.e. `organisation` or `loan.item.pid`.
+    :returns: function taking a record and returning the key.
+    """
+    levels = path.split('.')
+
+    def key(record):
+        value = record
+        for level in levels:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(level)
+        if isinstance(value, dict) and '$ref' in value:
+            return pid_from_ref(value['$ref'])
+        return value
+    return key
+
+
+def _leaf_remover(key):
+    """Build a function removing a key from a dict or a list of dicts."""
+    def remove(data):
+        if isinstance(data, list):
+            removed = False
+            for value in data:
+                removed = remove(value) or removed
+            return removed
+        if isinstance(data, dict) and key in data:
+            del data[key]
+            return True
+        return False
+    return remove
+
+
+def _level_remover(key, child):
+    """Build a function applying child remover on the value of a key."""
+    def remove(data):
+        if isinstance(data, list):
+            removed = False
+            for value in data:
+                removed = remove(value) or removed
+            return removed
+        if isinstance(data, dict) and key in data:
+            return child(data[key])
+        return False
+    return remove
+
+
+def path_remover(path):
+    """Compile a dotted path into a function removing it from a record.
+
+    Lists found at any level are traversed, i.e. `notes.content` removes
+    the content of every note.
+
+    :param path: dotted path of the field to remove.
+    :returns: function taking a dict and returning True if it changed.
+    """
+    *levels, leaf = path.split('.')
+    remover = _leaf_remover(leaf)
+    for level in reversed(levels):
+        remover = _level_remover(level, remover)
+    return remover
+
+
+def fields_remover(paths):
+    """Compile a list of dotted paths into a single remover.
+
+    :param paths: dotted paths of the fields to remove.
+    :returns: function taking a dict and returning True if it changed.
+    """
+    removers = [path_remover(path) for path in paths]
+
+    def remove(data):
+        removed = False
+        for remover in removers:
+            removed = remover(data) or removed
+        return removed
+    return remove
+
+
+def remove_subfields(values, patterns):
+    """Remove subfields from local field values.
+
+    Values use the `$a text $2 text` subfield syntax. The text outside of
+    the subfields is kept as is, values left empty are removed.
+
+    :param values: list of values of a local field.
+    :param patterns: dictionary of text by subfield code, a subfield is
+                     removed if its text contains the text of its code.
+    :returns: (new list of values, number of removed subfields).
+    """
+    new_values, removed = [], 0
+    for value in values:
+        value = str(value)
+        if '$' not in value:
+            new_values.append(value)
+            continue
+        kept, position = [], 0
+        value_removed = 0
+        for match in SUBFIELD_REGEX.finditer(value):
+            kept.append(value[position:match.start()])
+            position = match.end()
+            code, text = match.groups()
+            pattern = patterns.get(code)
+            if pattern and pattern in text:
+                value_removed += 1
+            else:
+                kept.append(match.group())
+        if not value_removed:
+            new_values.append(value)
+            continue
+        removed += value_removed
+        kept.append(value[position:])
+        new_value = ''.join(kept).strip()
+        if new_value:
+            new_values.append(new_value)
+    return new_values, removed
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""RERO ILS Tools output writers."""
+
+import atexit
+import json
+import os
+import threading
+from queue import Queue
+
+
+class BufferedJsonWriter:
+    """Write records as a JSON array, flushing them by blocks.
+
+    The output has the same layout as `rero_ils.modules.utils.JsonWriter`.
+    """
+
+    def __init__(self, filename, indent=2, buffer_size=1000):
+        """Constructor.
+
+        :param filename: output file name.
+        :param indent: JSON indentation.
+        :param buffer_size: number of records kept before a flush.
+        """
+        self.filename = filename
+        self.indent = indent
+        self.buffer_size = buffer_size
+        self.count = 0
+        self._buffer = []
+        self._file = open(filename, 'w')
+
+    def __enter__(self):
+        """Context manager enter."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Context manager exit."""
+        self.close()
+
+    def write(self, data):
+        """Add a record to the output.
+
+        :param data: JSON serializable record.
+        """
+        self._buffer.append(
+            json.dumps(data, indent=self.indent, ensure_ascii=False))
+        self.count += 1
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered records to the file."""
+        if not self._buffer:
+            return
+        separator = ',\n' if self.count > len(self._buffer) else '[\n'
+        self._file.write(separator + ',\n'.join(self._buffer))
+        self._buffer = []
+
+    def close(self):
+        """Flush the remaining records and close the JSON array."""
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.write('\n]\n' if self.count else '[]\n')
+        self._file.close()
+
+
+class PartitionedJsonWriter:
+    """Dispatch records to one lazily created JSON file per key."""
+
+    def __init__(self, pattern, key, buffer_size=1000):
+        """Constructor.
+
+        :param pattern: file name pattern with a `{key}` placeholder.
+        :param key: function returning the partition key of a record.
+        :param buffer_size: number of records kept before a flush.
+        """
+        self.pattern = pattern
+        self.key = key
+        self.buffer_size = buffer_size
+        self.writers = {}
+
+    def __enter__(self):
+        """Context manager enter."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Context manager exit."""
+        self.close()
+
+    def write(self, data):
+        """Add a record to the output of its partition.
+
+        :param data: JSON serializable record.
+        :returns: the partition key.
+        """
+        key = self.key(data)
+        writer = self.writers.get(key)
+        if writer is None:
+            writer = self.writers[key] = BufferedJsonWriter(
+                self.pattern.format(key=key), buffer_size=self.buffer_size)
+        writer.write(data)
+        return key
+
+    def counts(self):
+        """Number of records written per partition."""
+        return {key: writer.count for key, writer in self.writers.items()}
+
+    def close(self):
+        """Close all the partition outputs."""
+        for writer in self.writers.values():
+            writer.close()
+
+
+# end of the output of an asynchronous writer
+_CLOSE = object()
+
+
+class AsyncJsonWriter:
+    """Write records as a JSON array from a background thread.
+
+    The records are serialized by `write`, so later changes of the records
+    do not alter the output: serializing them in the background thread
+    would need a deep copy of each record, which costs as much as the
+    serialization. The file writes and flushes are done by a background
+    thread fed by a bounded queue. `sync` marks the batch
+    boundaries where the written records are synced to disk. The output
+    has the same layout as `rero_ils.modules.utils.JsonWriter`.
+    """
+
+    def __init__(self, filename, indent=2, queue_size=10000):
+        """Constructor.
+
+        :param filename: output file name.
+        :param indent: JSON indentation.
+        :param queue_size: number of records waiting to be written before
+                           `write` blocks.
+        """
+        self.filename = filename
+        self.indent = indent
+        self.count = 0
+        self._queue = Queue(queue_size)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name=f'writer-{filename}', daemon=True)
+        self._thread.start()
+        # the thread is a daemon, the output is completed at exit
+        atexit.register(self.close)
+
+    def __enter__(self):
+        """Context manager enter."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Context manager exit."""
+        self.close()
+
+    def write(self, data):
+        """Add a record to the output.
+
+        :param data: JSON serializable record.
+        """
+        self._check()
+        self._queue.put(
+            json.dumps(data, indent=self.indent, ensure_ascii=False))
+        self.count += 1
+
+    def sync(self, wait=False):
+        """Sync the written records to disk.
+
+        :param wait: wait until the records are on disk, i.e. before
+                     deleting the records of a backup.
+        """
+        self._check()
+        done = threading.Event()
+        self._queue.put(done)
+        if wait:
+            done.wait()
+            self._check()
+
+    def close(self):
+        """Write the remaining records, close the JSON array and sync."""
+        if self._closed:
+            return
+        self._closed = True
+        atexit.unregister(self.close)
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        self._check()
+
+    def _check(self):
+        """Raise the error of the background thread."""
+        if self._error:
+            raise self._error
+
+    def _run(self):
+        """Write the queued records until the writer is closed."""
+        try:
+            with open(self.filename, 'w') as out_file:
+                separator = '[\n'
+                while True:
+                    entry = self._queue.get()
+                    if entry is _CLOSE:
+                        out_file.write('\n]\n' if separator == ',\n'
+                                       else '[]\n')
+                        out_file.flush()
+                        os.fsync(out_file.fileno())
+                        return
+                    if isinstance(entry, threading.Event):
+                        out_file.flush()
+                        os.fsync(out_file.fileno())
+                        entry.set()
+                        continue
+                    out_file.write(separator + entry)
+                    separator = ',\n'
+        except Exception as err:
+            self._error = err
+            # release the writers waiting on the queue
+            while True:
+                entry = self._queue.get()
+                if isinstance(entry, threading.Event):
+                    entry.set()
+                elif entry is _CLOSE:
+                    return
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the tools commands outside of the production instance.
+
+`micro` times the pure python helpers without any service. `seed` creates
+synthetic documents, items and local fields in a local development
+instance (Postgres and Elasticsearch started with the rero-ils docker
+setup), `run` times the commands end to end on them and `clean` deletes
+them. Results are appended as JSON lines with the current git commit to
+be compared with `report`.
+"""
+
+import copy
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import click
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+TOOLS = os.path.join(SCRIPTS, 'tools.py')
+
+# marker of the synthetic records
+PREFIX = 'benchmark'
+
+
+def git_commit():
+    """Current git commit of the tools."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPTS,
+            check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save_result(results, name, scale, seconds):
+    """Print a timing and append it to the results file.
+
+    :param results: JSON lines results file.
+    :param name: name of the benchmark.
+    :param scale: number of records.
+    :param seconds: wall time.
+    """
+    result = {
+        'commit': git_commit(),
+        'date': datetime.now().isoformat(),
+        'name': name,
+        'scale': scale,
+        'seconds': seconds,
+        'records_per_second': scale / seconds if seconds else 0
+    }
+    click.echo(
+        f'{name:<25} {scale:>8} records {seconds:>9.3f}s '
+        f'{result["records_per_second"]:>10.0f}/s')
+    with open(results, 'a') as results_file:
+        results_file.write(json.dumps(result) + '\n')
+
+
+def best_time(func, repeat, setup=None):
+    """Best wall time of several calls of a function.
+
+    :param func: function to time.
+    :param repeat: number of calls.
+    :param setup: function building the argument of each call, i.e. fresh
+                  data for a function changing it, it is not timed.
+    """
+    timings = []
+    for _ in range(repeat):
+        args = [setup()] if setup else []
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+@click.group()
+def benchmark():
+    """Benchmark the tools commands."""
+
+
+@benchmark.command()
+@click.option('-n', '--number', type=int, default=100000,
+              help='Number of synthetic records.')
+@click.option('-r', '--repeat', type=int, default=3,
+              help='Number of runs, the best one is kept.')
+@click.option('-o', '--results', default='benchmarks.jsonl',
+              help='Results file.')
+def micro(number, repeat, results):
+    """Time the helpers without database and search."""
+    from rero_ils_tools.progress import ProgressReporter
+    from rero_ils_tools.utils import (fields_remover, key_from_path,
+                                      remove_subfields, sorted_difference,
+                                      sorted_pids)
+    from rero_ils_tools.writers import BufferedJsonWriter
+
+    values = [
+        f'$a {random.choice(["bib", "lib"])}{i % 50} $2 cdu-lib{i % 50} '
+        f'$b note {i}' for i in range(number)]
+    patterns = {'a': 'lib7', '2': 'cdu-lib7'}
+    save_result(results, 'remove_subfields', number, best_time(
+        lambda: remove_subfields(values, patterns), repeat))
+
+    templates = [{
+        'pid': str(i),
+        'data': {
+            'pid': str(i),
+            'barcode': f'{i}',
+            'notes': [
+                {'type': 'staff_note', 'content': 'note'} for _ in range(3)],
+            'document': {'$ref': f'https://ils.rero.ch/api/documents/{i}'}
+        }
+    } for i in range(number)]
+    remover = fields_remover(['data.pid', 'data.barcode', 'data.notes.type'])
+    # the remover changes the records, each run gets its own copy
+    save_result(results, 'fields_remover', number, best_time(
+        lambda records: [remover(record) for record in records], repeat,
+        setup=lambda: copy.deepcopy(templates)))
+
+    key = key_from_path('data.document')
+    save_result(results, 'key_from_path', number, best_time(
+        lambda: [key(template) for template in templates], repeat))
+
+    left = sorted_pids(str(i) for i in range(0, 2 * number, 2))
+    right = sorted_pids(str(i) for i in range(0, 2 * number, 3))
+    save_result(results, 'sorted_difference', number, best_time(
+        lambda: list(sorted_difference(left, right)), repeat))
+
+    with tempfile.TemporaryDirectory() as directory:
+        def write():
+            filename = os.path.join(directory, 'records.json')
+            with BufferedJsonWriter(filename) as writer:
+                for template in templates:
+                    writer.write(template)
+        save_result(results, 'buffered_json_writer', number,
+                    best_time(write, repeat))
+
+        def report():
+            progress = ProgressReporter(
+                'records', total=number,
+                log_file=os.path.join(directory, 'records.log'))
+            with redirect_stdout(io.StringIO()), progress:
+                for idx in range(number):
+                    progress.log(f'record # {idx} updated')
+                    progress.advance(updated=1)
+        save_result(results, 'progress_reporter', number,
+                    best_time(report, repeat))
+
+
+@benchmark.command()
+@click.option('-n', '--number', type=int, default=10000,
+              help='Number of synthetic items.')
+@click.option('-l', '--location_pid', default=None,
+              help='Location of the items, the first one by default.')
+@click.option('-t', '--item_type_pid', default=None,
+              help='Item type of the items, the first one by default.')
+@click.option('-m', '--manifest', default='benchmark_manifest.json',
+              help='File listing the created records.')
+@click.option('-b', '--batch_size', type=int, default=1000,
+              help='Number of records per commit.')
+def seed(number, location_pid, item_type_pid, manifest, batch_size):
+    """Create synthetic records in a development instance.
+
+    Every document has one item with a staff note for the bibliomedia
+    collection and one local field with the library code.
+    """
+    from invenio_db import db
+    from rero_ils.modules.documents.api import Document
+    from rero_ils.modules.item_types.api import ItemType
+    from rero_ils.modules.items.api import Item
+    from rero_ils.modules.libraries.api import Library
+    from rero_ils.modules.local_fields.api import LocalField
+    from rero_ils.modules.locations.api import Location
+    from rero_ils.modules.utils import get_ref_for_pid
+
+    from rero_ils_tools import create_app
+    from rero_ils_tools.api import BulkReindexer
+    from rero_ils_tools.utils import chunks
+
+    with create_app().app_context():
+        location_pid = location_pid or next(Location.get_all_pids())
+        item_type_pid = item_type_pid or next(ItemType.get_all_pids())
+        library = Library.get_record_by_pid(
+            Location.get_record_by_pid(location_pid).library_pid)
+        code = library.get('code')
+        data = {
+            'collection': PREFIX,
+            'library_pid': library.pid,
+            'library_code': code,
+            'organisation_pid': library.organisation_pid,
+            'documents': [],
+            'items': [],
+            'local_fields': [],
+            'barcodes': []
+        }
+        click.secho(
+            f'Seeding {number} documents for library {code}', fg='green')
+        for batch in chunks(range(number), batch_size):
+            reindexer = BulkReindexer()
+            for idx in batch:
+                document = Document.create({
+                    'type': [{
+                        'main_type': 'docmaintype_book',
+                        'subtype': 'docsubtype_other_book'
+                    }],
+                    'title': [{
+                        'type': 'bf:Title',
+                        'mainTitle': [{'value': f'{PREFIX} {idx}'}]
+                    }],
+                    'language': [{'type': 'bf:Language', 'value': 'fre'}],
+                    'provisionActivity': [{
+                        'type': 'bf:Publication',
+                        'startDate': 2000
+                    }],
+                    'issuance': {
+                        'main_type': 'rdami:1001',
+                        'subtype': 'materialUnit'
+                    },
+                    'adminMetadata': {'encodingLevel': 'Minimal level'}
+                }, dbcommit=False, reindex=False)
+                barcode = f'{PREFIX}{idx}'
+                item = Item.create({
+                    'barcode': barcode,
+                    'type': 'standard',
+                    'status': 'on_shelf',
+                    'document': {
+                        '$ref': get_ref_for_pid('documents', document.pid)},
+                    'location': {
+                        '$ref': get_ref_for_pid('locations', location_pid)},
+                    'item_type': {
+                        '$ref': get_ref_for_pid('item_types', item_type_pid)},
+                    'notes': [{'type': 'staff_note', 'content': PREFIX}]
+                }, dbcommit=False, reindex=False)
+                local_field = LocalField.create({
+                    'parent': {
+                        '$ref': get_ref_for_pid('documents', document.pid)},
+                    'organisation': {
+                        '$ref': get_ref_for_pid(
+                            'organisations', library.organisation_pid)},
+                    'fields': {
+                        'field_1': [f'$a {code} $2 cdu-{code} $b {PREFIX}']
+                    }
+                }, dbcommit=False, reindex=False)
+                for record in document, item, local_field:
+                    reindexer.add(record)
+                data['documents'].append(document.pid)
+                data['items'].append(item.pid)
+                data['local_fields'].append(local_field.pid)
+                data['barcodes'].append(barcode)
+            db.session.commit()
+            reindexer.flush()
+            click.echo(f'{len(data["documents"])} documents')
+    with open(manifest, 'w') as manifest_file:
+        json.dump(data, manifest_file)
+
+
+def run_tools(*args):
+    """Run a tools command and return its wall time."""
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, TOOLS, 'tools', *args], check=True,
+        stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+@benchmark.command()
+@click.option('-m', '--manifest', default='benchmark_manifest.json',
+              help='File listing the seeded records.')
+@click.option('-o', '--results', default='benchmarks.jsonl',
+              help='Results file.')
+def run(manifest, results):
+    """Time the commands end to end on the seeded records.
+
+    Deletions run in plan or no update mode, so the seeded records can be
+    used again. Patrons are not seeded, duplicate_emails runs on the
+    patrons of the instance.
+    """
+    from rero_ils.modules.patrons.api import PatronsSearch
+
+    from rero_ils_tools import create_app
+
+    with open(manifest) as manifest_file:
+        data = json.load(manifest_file)
+    number = len(data['items'])
+    with create_app().app_context():
+        patrons = PatronsSearch().count()
+    with tempfile.TemporaryDirectory() as directory:
+        query_file = os.path.join(directory, 'query.txt')
+        with open(query_file, 'w') as out_file:
+            out_file.write(f'barcode:{PREFIX}*\n')
+        save_result(results, 'query', number, run_tools(
+            'search', 'query', '-t', 'item', query_file,
+            '-o', os.path.join(directory, 'items.json')))
+
+        update_file = os.path.join(directory, 'update.json')
+        with open(update_file, 'w') as out_file:
+            json.dump([
+                {'pid': pid, 'call_number': f'{PREFIX} {datetime.now()}'}
+                for pid in data['items']
+            ], out_file)
+        save_result(results, 'items update', number, run_tools(
+            'update', 'items', update_file))
+
+        save_result(results, 'duplicate_emails', patrons, run_tools(
+            'patrons', 'duplicate_emails'))
+
+        save_result(results, 'bibliomedia plan', number, run_tools(
+            'delete', 'bibliomedia', data['collection'],
+            '-p', os.path.join(directory, 'bibliomedia.plan')))
+
+        barcodes_file = os.path.join(directory, 'barcodes.txt')
+        with open(barcodes_file, 'w') as out_file:
+            out_file.write('\n'.join(data['barcodes']) + '\n')
+        save_result(results, 'vs no update', number, run_tools(
+            'desherbage', 'vs', barcodes_file, '-l', data['library_pid'],
+            '-c', data['library_code'], '-s', directory, '-n'))
+
+
+@benchmark.command()
+@click.option('-m', '--manifest', default='benchmark_manifest.json',
+              help='File listing the seeded records.')
+def clean(manifest):
+    """Delete the seeded records."""
+    from rero_ils.modules.documents.api import Document
+    from rero_ils.modules.holdings.api import Holding
+    from rero_ils.modules.items.api import Item
+    from rero_ils.modules.local_fields.api import LocalField
+
+    from rero_ils_tools import create_app
+    from rero_ils_tools.api import BulkDeleter, fetch_many
+
+    with open(manifest) as manifest_file:
+        data = json.load(manifest_file)
+    with create_app().app_context(), BulkDeleter() as deleter:
+        for record_class, pids in [(LocalField, data['local_fields']),
+                                   (Item, data['items'])]:
+            for _, record in fetch_many(record_class, pids):
+                if record:
+                    holding_pid = getattr(record, 'holding_pid', None)
+                    deleter.add(record)
+                    if holding_pid:
+                        deleter.add(Holding.get_record_by_pid(holding_pid))
+        deleter.flush()
+        for _, document in fetch_many(Document, data['documents']):
+            if document:
+                deleter.add(document)
+    click.secho(f'Deleted: {deleter.deleted}', fg='green')
+
+
+@benchmark.command()
+@click.option('-o', '--results', default='benchmarks.jsonl',
+              help='Results file.')
+@click.option('-c', '--commits', type=int, default=5,
+              help='Number of last commits to compare.')
+def report(results, commits):
+    """Compare the results of the last commits."""
+    timings, order = {}, []
+    with open(results) as results_file:
+        for line in results_file:
+            result = json.loads(line)
+            if result['commit'] not in order:
+                order.append(result['commit'])
+            # the last result of a commit wins
+            timings.setdefault(result['name'], {})[result['commit']] = result
+    order = order[-commits:]
+    click.echo(f'{"":<25}' + ''.join(f'{commit:>12}' for commit in order))
+    for name, by_commit in timings.items():
+        click.echo(f'{name:<25}' + ''.join(
+            f'{by_commit[commit]["seconds"]:>11.3f}s'
+            if commit in by_commit else f'{"-":>12}' for commit in order))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the startup time of the tools command line."""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+TOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tools.py')
+
+COMMANDS = [
+    ['tools', '--help'],
+    ['tools', 'desherbage', '--help'],
+    ['tools', 'update', 'items', '--help'],
+    # runs a command: the application is created
+    ['tools', 'app', 'x'],
+]
+
+
+@click.command()
+@click.option('-n', '--number', type=int, default=10,
+              help='Number of runs per command.')
+def benchmark_startup(number):
+    """Run each command several times and print its wall time."""
+    for command in COMMANDS:
+        timings = []
+        for _ in range(number):
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, TOOLS, *command], check=True,
+                stdout=subprocess.DEVNULL)
+            timings.append(time.perf_counter() - start)
+        click.echo(
+            f'{" ".join(command):<35} min: {min(timings):.3f}s '
+            f'mean: {statistics.mean(timings):.3f}s')
+
+
+if __name__ == "__main__":
+    benchmark_startup()
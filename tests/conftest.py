@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Common pytest fixtures."""
+
+import pytest
+
+
+@pytest.fixture(scope='module')
+def app():
+    """RERO ILS application, no service is used."""
+    pytest.importorskip('rero_ils')
+    from rero_ils_tools import create_app
+    app = create_app()
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture()
+def stand_in(app, monkeypatch):
+    """Stand-in index answering all the searches."""
+    from .stand_in import StandInIndex
+    index = StandInIndex()
+    index.install(monkeypatch)
+    return index
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""In memory stand-in of the elasticsearch indexes.
+
+The searches are evaluated on documents kept in memory, whatever their
+search class, so the record API and the tools see the same index. The
+bulk deletions of the tools are applied to the documents too. Only the
+queries and aggregations used by the records links are supported, an
+unsupported query fails the test instead of returning wrong hits.
+"""
+
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.response import Response
+from flask import current_app
+
+
+def field_values(document, path):
+    """Values of a dotted field of a document, through the lists."""
+    values = [document]
+    for name in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, list):
+                value = [v.get(name) for v in value if isinstance(v, dict)]
+            elif isinstance(value, dict):
+                value = value.get(name)
+            else:
+                continue
+            if isinstance(value, list):
+                found.extend(v for v in value if v is not None)
+            elif value is not None:
+                found.append(value)
+        values = found
+    return values
+
+
+def same_value(value, term):
+    """Compare an indexed value with a term like a keyword field."""
+    return value == term or str(value) == str(term)
+
+
+class StandInIndex:
+    """Documents by index name answering the searches."""
+
+    def __init__(self):
+        """Constructor."""
+        self.documents = {}
+
+    def add(self, search_class, document):
+        """Index a document.
+
+        :param search_class: search class of the index.
+        :param document: document with a pid.
+        """
+        self.documents.setdefault(search_class.Meta.index, []).append(
+            document)
+
+    def install(self, monkeypatch):
+        """Answer all the searches with this index."""
+        stand_in = self
+
+        def count(search):
+            return len(stand_in.hits(search))
+
+        def execute(search, ignore_cache=False):
+            return Response(search, stand_in.response(search))
+
+        def scan(search):
+            for document in stand_in.hits(search):
+                yield search._get_result(document)
+
+        from rero_ils_tools import api
+        monkeypatch.setattr(Search, 'count', count)
+        monkeypatch.setattr(Search, 'execute', execute)
+        monkeypatch.setattr(Search, 'scan', scan)
+        monkeypatch.setattr(api, 'bulk', self.bulk)
+
+    def bulk(self, client, actions, **kwargs):
+        """Apply bulk delete actions, documents are identified by pid.
+
+        :returns: number of applied actions and list of errors.
+        """
+        count, errors = 0, []
+        for action in actions:
+            if action.get('_op_type') != 'delete':
+                raise NotImplementedError(f'bulk action {action}')
+            documents = self.documents.get(
+                self._index_name(action['_index']), [])
+            kept = [doc for doc in documents if doc['pid'] != action['_id']]
+            if len(kept) == len(documents):
+                errors.append({'delete': {
+                    '_id': action['_id'], 'status': 404}})
+            else:
+                documents[:] = kept
+                count += 1
+        return count, errors
+
+    def hits(self, search):
+        """Raw hits of all the documents matching a search."""
+        body = search.to_dict()
+        query = body.get('query', {'match_all': {}})
+        post_filter = body.get('post_filter', {'match_all': {}})
+        hits = []
+        for index in search._index or self.documents:
+            name = self._index_name(index)
+            for document in self.documents.get(name, []):
+                if self.match(document, query) and \
+                        self.match(document, post_filter):
+                    hits.append({
+                        '_index': index,
+                        '_id': document['pid'],
+                        '_source': document
+                    })
+        return hits
+
+    def response(self, search):
+        """Raw response of a search."""
+        body = search.to_dict()
+        hits = self.hits(search)
+        start = body.get('from', 0)
+        response = {
+            'took': 0,
+            'timed_out': False,
+            'hits': {
+                'total': {'value': len(hits), 'relation': 'eq'},
+                'hits': hits[start:start + body.get('size', 10)]
+            }
+        }
+        if body.get('aggs'):
+            response['aggregations'] = {
+                name: self.aggregation(hits, agg)
+                for name, agg in body['aggs'].items()
+            }
+        return response
+
+    def aggregation(self, hits, agg):
+        """Raw result of a terms aggregation."""
+        [(agg_type, params)] = [
+            (key, value) for key, value in agg.items() if key != 'aggs']
+        if agg_type != 'terms' or agg.get('aggs'):
+            raise NotImplementedError(f'aggregation {agg}')
+        counts = {}
+        for hit in hits:
+            # a document is counted once per distinct value
+            for value in set(field_values(hit['_source'], params['field'])):
+                counts[value] = counts.get(value, 0) + 1
+        buckets = sorted(counts.items(), key=lambda bucket: -bucket[1])
+        return {
+            'doc_count_error_upper_bound': 0,
+            'sum_other_doc_count': 0,
+            'buckets': [
+                {'key': key, 'doc_count': doc_count}
+                for key, doc_count in buckets[:params.get('size', 10)]
+            ]
+        }
+
+    def match(self, document, query):
+        """Check if a document matches a query."""
+        [(query_type, params)] = query.items()
+        if query_type == 'match_all':
+            return True
+        if query_type == 'bool':
+            return self._match_bool(document, params)
+        [(field, value)] = params.items()
+        values = field_values(document, field)
+        if query_type in ('term', 'match'):
+            if isinstance(value, dict):
+                value = value.get('value', value.get('query'))
+            return any(same_value(v, value) for v in values)
+        if query_type == 'terms':
+            return any(same_value(v, t) for v in values for t in value)
+        if query_type == 'exists':
+            return bool(field_values(document, value))
+        if query_type == 'range':
+            return any(self._in_range(v, value) for v in values)
+        raise NotImplementedError(f'query {query}')
+
+    def _match_bool(self, document, params):
+        """Check if a document matches a bool query."""
+        def clauses(occur):
+            clause = params.get(occur, [])
+            return clause if isinstance(clause, list) else [clause]
+
+        for occur in ('must', 'filter'):
+            if not all(self.match(document, q) for q in clauses(occur)):
+                return False
+        if any(self.match(document, q) for q in clauses('must_not')):
+            return False
+        should = clauses('should')
+        if should:
+            minimum = params.get(
+                'minimum_should_match',
+                0 if clauses('must') or clauses('filter') else 1)
+            matches = sum(self.match(document, q) for q in should)
+            return matches >= int(minimum)
+        return True
+
+    @staticmethod
+    def _in_range(value, bounds):
+        """Check if a value is in the bounds of a range query."""
+        checks = {
+            'gt': lambda bound: value > bound,
+            'gte': lambda bound: value >= bound,
+            'lt': lambda bound: value < bound,
+            'lte': lambda bound: value <= bound
+        }
+        return all(checks[op](bound) for op, bound in bounds.items()
+                   if op in checks)
+
+    @staticmethod
+    def _index_name(index):
+        """Name of an index without the application prefix."""
+        prefix = current_app.config.get('SEARCH_INDEX_PREFIX') or ''
+        return index[len(prefix):] if index.startswith(prefix) else index
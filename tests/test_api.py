@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Bulk API tests."""
+
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('rero_ils')
+
+from rero_ils.modules.acquisition.acq_order_lines.api import \
+    AcqOrderLinesSearch  # noqa
+from rero_ils.modules.collections.api import CollectionsSearch  # noqa
+from rero_ils.modules.documents.api import Document, DocumentsSearch  # noqa
+from rero_ils.modules.holdings.api import HoldingsSearch  # noqa
+from rero_ils.modules.items.api import Item, ItemsSearch  # noqa
+from rero_ils.modules.loans.api import LoansSearch  # noqa
+from rero_ils.modules.loans.models import LoanState  # noqa
+from rero_ils.modules.local_fields.api import LocalFieldsSearch  # noqa
+from rero_ils.modules.patron_transactions.api import \
+    PatronTransactionsSearch  # noqa
+
+from rero_ils_tools import api  # noqa
+from rero_ils_tools.indexing import IndexingController  # noqa
+
+
+def load_from(records, monkeypatch):
+    """Load the records from memory instead of the database."""
+    def get_records_by_pids(record_class, pids, size=api.TERMS_SIZE):
+        return {pid: records[pid] for pid in pids if pid in records}
+    monkeypatch.setattr(api, 'get_records_by_pids', get_records_by_pids)
+
+
+def test_items_reasons_not_to_delete(stand_in, monkeypatch):
+    """Bulk reasons are the reasons of the record API."""
+    states = [
+        value for name, value in vars(LoanState).items() if name.isupper()]
+    items = {}
+
+    def new_item():
+        pid = str(len(items) + 1)
+        items[pid] = Item({'pid': pid, 'barcode': f'barcode{pid}'})
+        return pid
+
+    for state in states:
+        pid = new_item()
+        stand_in.add(LoansSearch, {
+            'pid': f'loan{pid}', 'state': state, 'document_pid': '1',
+            'item_pid': {'value': pid, 'type': 'item'}})
+    first, second = new_item(), new_item()
+    stand_in.add(CollectionsSearch, {
+        'pid': 'collection1', 'items': [{'pid': first}, {'pid': second}]})
+    for status in ('open', 'closed'):
+        pid = new_item()
+        stand_in.add(PatronTransactionsSearch, {
+            'pid': f'fee{pid}', 'status': status, 'type': 'overdue',
+            'total_amount': 1.0, 'item': {'pid': pid}})
+    pid = new_item()
+    stand_in.add(LocalFieldsSearch, {
+        'pid': 'local1', 'parent': {'type': 'item', 'pid': pid}})
+    for _ in range(3):
+        new_item()
+    load_from(items, monkeypatch)
+
+    expected = {pid: item.reasons_not_to_delete()
+                for pid, item in items.items()}
+    # the stand-in index is used by the record API
+    assert any(expected.values())
+    assert api.get_items_reasons_not_to_delete(items, size=4) == expected
+
+
+def test_documents_reasons_not_to_delete(stand_in):
+    """Bulk reasons are the reasons of the record API."""
+    documents = {}
+
+    def new_document(**data):
+        pid = str(len(documents) + 1)
+        documents[pid] = Document({'pid': pid, **data})
+        return pid
+
+    pid = new_document()
+    stand_in.add(ItemsSearch, {
+        'pid': 'item1', 'document': {'pid': pid}})
+    pid = new_document()
+    stand_in.add(HoldingsSearch, {
+        'pid': 'holding1', 'document': {'pid': pid}})
+    pid = new_document()
+    stand_in.add(LoansSearch, {
+        'pid': 'loan1', 'state': LoanState.ITEM_RETURNED,
+        'document_pid': pid, 'item_pid': {'value': 'item2', 'type': 'item'}})
+    pid = new_document()
+    stand_in.add(AcqOrderLinesSearch, {
+        'pid': 'order_line1', 'document': {'pid': pid}})
+    for field in api.DOCUMENT_RELATION_FIELDS:
+        pid = new_document()
+        # the linked document is indexed with the relation to it
+        *path, name = field.split('.')
+        relation = {name: pid}
+        for key in reversed(path[1:]):
+            relation = {key: relation}
+        stand_in.add(DocumentsSearch, {
+            'pid': f'{path[0]}{pid}', path[0]: [relation]})
+    pid = new_document()
+    stand_in.add(LocalFieldsSearch, {
+        'pid': 'local1', 'parent': {'type': 'doc', 'pid': pid}})
+    new_document(harvested=True)
+    for _ in range(3):
+        new_document()
+
+    expected = {pid: document.reasons_not_to_delete()
+                for pid, document in documents.items()}
+    # the stand-in index is used by the record API
+    assert any(expected.values())
+    assert api.get_documents_reasons_not_to_delete(
+        documents, size=4) == expected
+
+
+class RecordingSession:
+    """Database session recording the transactions."""
+
+    def __init__(self, events, commit_error=None):
+        """Constructor."""
+        self.events = events
+        self.commit_error = commit_error
+
+    @contextmanager
+    def begin_nested(self):
+        """Savepoint, rolled back on error."""
+        try:
+            yield
+        except Exception:
+            self.events.append('savepoint rollback')
+            raise
+
+    def commit(self):
+        """Commit or fail."""
+        if self.commit_error:
+            raise self.commit_error
+        self.events.append('commit')
+
+    def rollback(self):
+        """Rollback."""
+        self.events.append('rollback')
+
+
+class DeletableRecord(dict):
+    """Record recording its deletion, the id is the pid."""
+
+    def __init__(self, pid_type, pid, events, error=None):
+        """Constructor."""
+        super().__init__(pid=pid)
+        self.provider = SimpleNamespace(pid_type=pid_type)
+        self.id = pid
+        self.events = events
+        self.error = error
+
+    def delete(self, dbcommit=False, delindex=False):
+        """Delete or fail."""
+        if self.error:
+            raise self.error
+        self.events.append(f'delete {self.id}')
+
+
+SEARCHES = {
+    'item': ItemsSearch,
+    'hold': HoldingsSearch,
+    'doc': DocumentsSearch,
+    'lofi': LocalFieldsSearch
+}
+
+
+@pytest.fixture()
+def events(stand_in, monkeypatch):
+    """Transactions and callbacks of the deleter, in order."""
+    events = []
+    monkeypatch.setattr(api, 'db', SimpleNamespace(
+        session=RecordingSession(events)))
+    monkeypatch.setattr(
+        IndexingController, 'index',
+        lambda self, ids, doc_type: events.append(f'index {sorted(ids)}'))
+    return events
+
+
+def new_record(stand_in, events, pid_type, pid, error=None):
+    """Indexed record of the given type."""
+    stand_in.add(SEARCHES[pid_type], {'pid': pid})
+    return DeletableRecord(pid_type, pid, events, error)
+
+
+def indexed_pids(stand_in):
+    """Pids remaining in the stand-in index."""
+    return sorted(
+        document['pid'] for documents in stand_in.documents.values()
+        for document in documents)
+
+
+def callback(events):
+    """Deletion callback recording its calls."""
+    return lambda record, error: events.append(
+        f'callback {record.id} {error}')
+
+
+def test_bulk_deleter_order(stand_in, events):
+    """Records are deleted in dependency order, then committed."""
+    deleter = api.BulkDeleter()
+    for pid_type in ('lofi', 'doc', 'hold', 'item'):
+        deleter.add(new_record(stand_in, events, pid_type, pid_type),
+                    callback=callback(events))
+    deleter.flush()
+    assert events == [
+        'delete item', 'delete hold', 'delete doc', 'delete lofi',
+        'commit',
+        'callback item None', 'callback hold None', 'callback doc None',
+        'callback lofi None',
+        'commit'
+    ]
+    assert indexed_pids(stand_in) == []
+    assert deleter.deleted == {'item': 1, 'hold': 1, 'doc': 1, 'lofi': 1}
+
+
+def test_bulk_deleter_failing_record(stand_in, events):
+    """A failing record is rolled back to its savepoint only."""
+    error = ValueError('linked')
+    deleter = api.BulkDeleter()
+    deleter.add(new_record(stand_in, events, 'item', '1'),
+                callback=callback(events))
+    deleter.add(new_record(stand_in, events, 'item', '2', error),
+                callback=callback(events))
+    deleter.flush()
+    assert events == [
+        'delete 1', 'savepoint rollback', 'commit',
+        'callback 1 None', 'callback 2 linked', 'commit'
+    ]
+    assert indexed_pids(stand_in) == ['2']
+    assert deleter.deleted == {'item': 1}
+
+
+def test_bulk_deleter_dry_run(stand_in, events):
+    """A dry run rolls the deletions back and keeps the index."""
+    deleter = api.BulkDeleter(dbcommit=False)
+    deleter.add(new_record(stand_in, events, 'item', '1'),
+                callback=callback(events))
+    deleter.flush()
+    assert events == [
+        'delete 1', 'rollback', 'callback 1 None', 'rollback']
+    assert indexed_pids(stand_in) == ['1']
+    assert deleter.deleted == {}
+    # nothing is committed by an empty flush
+    deleter.flush()
+    assert 'commit' not in events
+
+
+def test_bulk_deleter_commit_error(stand_in, events, monkeypatch):
+    """A failed commit is given to the callbacks and the index restored."""
+    error = RuntimeError('commit failed')
+    monkeypatch.setattr(api, 'db', SimpleNamespace(
+        session=RecordingSession(events, commit_error=error)))
+    deleter = api.BulkDeleter()
+    deleter.add(new_record(stand_in, events, 'item', '1'),
+                callback=callback(events))
+    with pytest.raises(RuntimeError):
+        deleter.flush()
+    assert events == [
+        'delete 1', 'rollback', "index ['1']", 'callback 1 commit failed']
+    assert deleter.deleted == {}
+
+
+def test_bulk_deleter_callback_records(stand_in, events):
+    """Records added by a callback are deleted in a next batch."""
+    deleter = api.BulkDeleter()
+    local_field = new_record(stand_in, events, 'lofi', 'lofi')
+
+    def document_deleted(record, error):
+        events.append(f'callback {record.id} {error}')
+        deleter.add(local_field, callback=callback(events))
+
+    deleter.add(new_record(stand_in, events, 'doc', 'doc'),
+                callback=document_deleted)
+    deleter.flush()
+    assert events == [
+        'delete doc', 'commit', 'callback doc None',
+        'delete lofi', 'commit', 'callback lofi None',
+        'commit'
+    ]
+    assert deleter.deleted == {'doc': 1, 'lofi': 1}
+
+
+class StoredRecord(dict):
+    """Record loaded from memory, the id is the pid."""
+
+    store = {}
+
+    @property
+    def id(self):
+        """Record id."""
+        return self['pid']
+
+    @classmethod
+    def get_records(cls, ids):
+        """Load records by id."""
+        return [cls.store[_id] for _id in ids if _id in cls.store]
+
+
+@pytest.fixture()
+def loads(monkeypatch):
+    """Pids loaded by each database query of fetch_many."""
+    loads = []
+    StoredRecord.store = {
+        str(pid): StoredRecord(pid=str(pid), barcode=f'b{pid}')
+        for pid in range(1, 8)
+    }
+
+    def load_by_pids(record_class, pids):
+        loads.append(sorted(pids))
+        return {
+            pid: StoredRecord.store[pid]
+            for pid in pids if pid in StoredRecord.store
+        }
+    monkeypatch.setattr(api, '_load_by_pids', load_by_pids)
+    return loads
+
+
+def test_fetch_many(app, loads):
+    """Records are loaded by chunks and returned in the input order."""
+    pids = ['5', '1', 'missing', '3', '5', '7', '2']
+    records = list(api.fetch_many(StoredRecord, pids, chunk_size=3))
+    assert [pid for pid, _ in records] == pids
+    assert [record and record['pid'] for _, record in records] == [
+        '5', '1', None, '3', '5', '7', '2']
+    assert loads == [['1', '5', 'missing'], ['3', '5', '7'], ['2']]
+
+
+def test_fetch_many_key_and_cache(app, loads):
+    """Values are mapped to pids and cached records are not loaded."""
+    cache = {}
+    values = [{'pid': '2'}, {'pid': None}, {'pid': '4'}]
+    records = list(api.fetch_many(
+        StoredRecord, values, key=lambda value: value['pid'], cache=cache))
+    assert [(value, record and record['pid'])
+            for value, record in records] == [
+        ({'pid': '2'}, '2'), ({'pid': None}, None), ({'pid': '4'}, '4')]
+    assert loads == [['2', '4']]
+    list(api.fetch_many(StoredRecord, ['4', '6'], cache=cache))
+    assert loads == [['2', '4'], ['6']]
+    assert sorted(cache) == ['2', '4', '6']
+
+
+def test_get_records_by_pids(app, loads):
+    """Unknown pids are missing."""
+    records = api.get_records_by_pids(StoredRecord, ['3', 'x', '1'], 2)
+    assert sorted(records) == ['1', '3']
+
+
+def test_fetch_by_field(stand_in, loads):
+    """Records are found by field value in the input order."""
+    for record in StoredRecord.store.values():
+        stand_in.add(ItemsSearch, dict(record))
+    barcodes = ['b4', 'unknown', 'b1', 'b4', 'b7']
+    records = list(api.fetch_by_field(
+        StoredRecord, ItemsSearch(), chunk_size=2, barcode=barcodes))
+    assert [(barcode, record and record['pid'])
+            for barcode, record in records] == [
+        ('b4', '4'), ('unknown', None), ('b1', '1'), ('b4', '4'),
+        ('b7', '7')]
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Indexing controller tests."""
+
+import threading
+import time
+
+import pytest
+
+from rero_ils_tools.indexing import BulkRejected, IndexingController, \
+    is_rejection, rejected_errors
+
+
+def test_batch_size_aimd():
+    """Fast requests grow the batches, slow requests halve them."""
+    controller = IndexingController(
+        min_batch=10, max_batch=100, increase=10, max_concurrency=1)
+    sizes = []
+    controller.bulk(range(200), lambda batch: sizes.append(len(batch)))
+    assert sizes == [25, 35, 45, 55, 40]
+    assert controller.batch_size == 75
+    assert controller.sent == 200
+
+    controller.target_latency = -1
+    sizes = []
+    controller.bulk(range(100), lambda batch: sizes.append(len(batch)))
+    assert sizes == [75, 25]
+    assert controller.batch_size == 18
+
+
+def test_rejected_batch_is_split():
+    """A rejected batch is sent again at the decreased batch size."""
+    controller = IndexingController(
+        min_batch=10, max_batch=400, increase=10, backoff=0)
+    sent, rejected = [], []
+
+    def send(batch):
+        if not rejected:
+            rejected.append(batch)
+            raise BulkRejected('rejected')
+        sent.append(batch)
+
+    controller.bulk(range(100), send)
+    assert [len(batch) for batch in rejected] == [100]
+    assert [len(batch) for batch in sent] == [50, 50]
+    assert [item for batch in sent for item in batch] == list(range(100))
+    assert controller.rejections == 1
+    assert controller.sent == 100
+
+
+def test_rejections_give_up():
+    """A batch always rejected fails after the retries."""
+    controller = IndexingController(
+        min_batch=10, max_batch=400, max_retries=2, backoff=0)
+    calls = []
+
+    def send(batch):
+        calls.append(batch)
+        raise BulkRejected('rejected')
+
+    with pytest.raises(BulkRejected):
+        controller.bulk(range(20), send)
+    assert len(calls) == 3
+
+
+def test_other_errors_are_raised():
+    """Errors other than rejections are not retried."""
+    controller = IndexingController(backoff=0)
+    calls = []
+
+    def send(batch):
+        calls.append(batch)
+        raise ValueError('mapping error')
+
+    with pytest.raises(ValueError):
+        controller.bulk(range(20), send)
+    assert len(calls) == 1
+
+
+def test_is_rejection():
+    """Rejections are detected in the bulk errors."""
+    rejected = {'delete': {'_id': '1', 'status': 429}}
+    missing = {'delete': {'_id': '2', 'status': 404}}
+    assert rejected_errors([rejected, missing]) == [rejected]
+    error = Exception()
+    error.errors = [missing, rejected]
+    assert is_rejection(error)
+    error.errors = [missing]
+    assert not is_rejection(error)
+    error = Exception()
+    error.status_code = 429
+    assert is_rejection(error)
+
+
+def test_max_rate():
+    """The number of documents per second is limited."""
+    controller = IndexingController(
+        max_rate=1000, min_batch=50, max_batch=50)
+    start = time.monotonic()
+    controller.bulk(range(200), lambda batch: None)
+    # the first batch is sent at once, the next three wait 50ms each
+    assert time.monotonic() - start >= 0.14
+
+
+def test_concurrency():
+    """The requests of several threads are limited and adapted."""
+    controller = IndexingController(
+        min_batch=1, max_batch=1, max_concurrency=2)
+    lock = threading.Lock()
+    running, peak = [0], [0]
+
+    def send(batch):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+
+    threads = [
+        threading.Thread(target=controller.bulk, args=(range(10), send))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert peak[0] == 2
+    assert controller.sent == 40
+
+    controller.target_latency = 0
+    controller.bulk(range(2), send)
+    assert controller.concurrency == 1
+    assert controller.running == 0
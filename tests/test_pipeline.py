@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Staged pipeline tests."""
+
+import pytest
+from flask import Flask, current_app
+
+from rero_ils_tools.pipeline import Pipeline, Stage
+
+
+def create_app():
+    """Application of the worker processes."""
+    return Flask('tests')
+
+
+def square(value):
+    """Square of a value with the name of the current application."""
+    return current_app.name, value * value
+
+
+def fail_on(value, failing):
+    """Raise an error for the failing values."""
+    if value in failing:
+        raise ValueError(f'failed {value}')
+    return value
+
+
+def test_pipeline_order_and_stats():
+    """Items go through the stages in order, None results are dropped."""
+    output = []
+    pipeline = Pipeline([
+        Stage('double', lambda value: value * 2),
+        Stage('even', lambda value: value if value % 4 else None),
+        Stage('output', output.append)
+    ])
+    stats = pipeline.run(range(20))
+    assert output == [value * 2 for value in range(20) if value % 2]
+    assert stats == {
+        'double': {'received': 20, 'sent': 20, 'errors': 0},
+        'even': {'received': 20, 'sent': 10, 'errors': 0},
+        # list.append returns None
+        'output': {'received': 10, 'sent': 0, 'errors': 0}
+    }
+
+
+def test_pipeline_workers():
+    """All the items go through stages with several workers."""
+    output = []
+    pipeline = Pipeline([
+        Stage('double', lambda value: value * 2, workers=3),
+        Stage('output', output.append)
+    ], queue_size=4)
+    stats = pipeline.run(range(100))
+    assert sorted(output) == [value * 2 for value in range(100)]
+    assert stats['double'] == {'received': 100, 'sent': 100, 'errors': 0}
+
+
+def test_pipeline_on_error():
+    """Errors are given to on_error and the other items go on."""
+    errors, output = [], []
+    pipeline = Pipeline([
+        Stage('check', lambda value: fail_on(value, {3, 7})),
+        Stage('output', output.append)
+    ], on_error=lambda stage, item, err: errors.append(
+        (stage.name, item, str(err))))
+    stats = pipeline.run(range(10))
+    assert output == [0, 1, 2, 4, 5, 6, 8, 9]
+    assert errors == [('check', 3, 'failed 3'), ('check', 7, 'failed 7')]
+    assert stats['check'] == {'received': 10, 'sent': 8, 'errors': 2}
+
+
+def test_pipeline_raises_at_the_end():
+    """Without on_error the first error is raised once all items ran."""
+    output = []
+    pipeline = Pipeline([
+        Stage('check', lambda value: fail_on(value, {3, 7})),
+        Stage('output', output.append)
+    ])
+    with pytest.raises(ValueError, match='failed 3'):
+        pipeline.run(range(10))
+    assert output == [0, 1, 2, 4, 5, 6, 8, 9]
+    assert pipeline.stats()['check']['errors'] == 2
+
+
+def test_pipeline_on_error_failure():
+    """An error of on_error is raised at the end of the run."""
+    def on_error(stage, item, err):
+        raise RuntimeError(f'on_error {item}')
+
+    pipeline = Pipeline([
+        Stage('check', lambda value: fail_on(value, {5}))
+    ], on_error=on_error)
+    with pytest.raises(RuntimeError, match='on_error 5'):
+        pipeline.run(range(10))
+
+
+def test_pipeline_processes():
+    """Process stages run in the application of their worker process."""
+    output = []
+    pipeline = Pipeline([
+        Stage('square', square, workers=2, processes=True),
+        Stage('output', output.append)
+    ], create_app=create_app)
+    stats = pipeline.run(range(10))
+    assert sorted(output) == [('tests', value * value) for value in range(10)]
+    assert stats['square'] == {'received': 10, 'sent': 10, 'errors': 0}
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Worker processes pool tests."""
+
+from flask import Flask
+
+from rero_ils_tools.pool import WorkerPool
+
+
+def create_app():
+    """Application of the worker processes."""
+    return Flask('tests')
+
+
+def count(chunk):
+    """Count the even and odd values of a chunk."""
+    return {
+        'even': sum(1 for value in chunk if value % 2 == 0),
+        'odd': sum(1 for value in chunk if value % 2)
+    }
+
+
+def fail_on_seven(chunk):
+    """Count the values of a chunk, fail on 7."""
+    if 7 in chunk:
+        raise ValueError('seven')
+    return {'values': len(chunk)}
+
+
+def test_map_chunks():
+    """Items are sent by chunks of chunk_size."""
+    pool = WorkerPool(workers=2, chunk_size=4, create_app=create_app)
+    results = list(pool.map(count, range(10)))
+    chunks = sorted(chunk for chunk, _, _ in results)
+    assert chunks == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    for chunk, result, error in results:
+        assert result == count(chunk)
+        assert error is None
+
+
+def test_run_counters():
+    """The counters of the chunks are summed."""
+    pool = WorkerPool(workers=2, chunk_size=3, create_app=create_app)
+    assert pool.run(count, range(101)) == {'even': 51, 'odd': 50}
+    assert pool.errors == []
+
+
+def test_run_errors():
+    """Failed chunks are kept with their traceback as text."""
+    pool = WorkerPool(workers=2, chunk_size=5, create_app=create_app)
+    assert pool.run(fail_on_seven, range(20)) == {'values': 15}
+    [(chunk, error)] = pool.errors
+    assert chunk == [5, 6, 7, 8, 9]
+    assert isinstance(error, str)
+    assert 'Traceback' in error and 'ValueError: seven' in error
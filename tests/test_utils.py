@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Utilities tests."""
+
+from array import array
+
+import pytest
+
+from rero_ils_tools.utils import key_from_path, remove_subfields, \
+    sorted_difference, sorted_pids
+
+PATTERNS = {'a': 'VS', '2': 'cdu-VS'}
+
+
+@pytest.mark.parametrize('values, expected, removed', [
+    (['$a VS $2 cdu-VS'], [], 2),
+    (['$a VS $2 cdu-VS $b note'], ['$b note'], 2),
+    (['$a GE $2 cdu-GE'], ['$a GE $2 cdu-GE'], 0),
+    (['no subfield VS'], ['no subfield VS'], 0),
+    (['$a VS', '$a VS $a VS', '$a GE'], ['$a GE'], 3),
+    # a $ without code is text, it is neither a subfield nor dropped
+    (['price 5$ $a VS'], ['price 5$'], 1),
+    (['a $ 5 $a VS'], ['a $ 5'], 1),
+    (['$b costs 5$ $a VS'], ['$b costs 5$'], 1),
+    (['$a VS $b 5 $ each $c $'], ['$b 5 $ each $c $'], 1),
+    (['text $a VS'], ['text'], 1),
+    ([12], ['12'], 0)
+])
+def test_remove_subfields(values, expected, removed):
+    """Matching subfields are removed, the other text is kept."""
+    assert remove_subfields(values, PATTERNS) == (expected, removed)
+
+
+def test_sorted_pids():
+    """Numeric pids are stored sorted and unique in an array."""
+    pids = sorted_pids(['10', '2', 2, '33', '10'])
+    assert isinstance(pids, array)
+    assert list(pids) == [2, 10, 33]
+    assert list(sorted_pids([])) == []
+
+
+@pytest.mark.parametrize('pids', [
+    ['2', 'a1', '10'],
+    # would be 7 as a number
+    ['007', '10'],
+    ['-1', '10'],
+    [str(2 ** 70), '10']
+])
+def test_sorted_pids_non_numeric(pids):
+    """Pids the array can not hold are kept as sorted strings."""
+    assert sorted_pids(pids + pids) == sorted(set(pids))
+
+
+@pytest.mark.parametrize('left, right, expected', [
+    # disjoint
+    ([1, 3, 5], [2, 4, 6], [1, 3, 5]),
+    ([1, 2], [3, 4], [1, 2]),
+    ([3, 4], [1, 2], [3, 4]),
+    # overlapping
+    ([1, 2, 3, 4, 5], [2, 4, 6], [1, 3, 5]),
+    ([1, 2, 3], [1, 2, 3], []),
+    ([2, 3], [1, 2, 3, 4], []),
+    # empty
+    ([], [1, 2], []),
+    ([1, 2], [], [1, 2]),
+    ([], [], []),
+    # duplicates
+    ([1, 1, 2, 2, 3], [2], [1, 3]),
+    ([1, 2, 3], [2, 2, 2], [1, 3]),
+])
+def test_sorted_difference(left, right, expected):
+    """Values of left missing in right, in order."""
+    assert list(sorted_difference(left, right)) == expected
+    assert list(sorted_difference(
+        array('Q', left), array('Q', right))) == expected
+
+
+def test_sorted_difference_of_pids():
+    """Numeric and string pids are compared as strings."""
+    loaned = sorted_pids(['1', '2', '10', '2'])
+    status = sorted_pids(['2', 'b3', '10'])
+    assert list(sorted_difference(loaned, status)) == ['1']
+    assert list(sorted_difference(status, loaned)) == ['b3']
+    assert list(sorted_difference(
+        sorted_pids(['1', '2', '10']), sorted_pids(['10']))) == [1, 2]
+
+
+ORG_REF = 'https://bib.rero.ch/api/organisations/1'
+
+
+@pytest.mark.parametrize('path, record, expected', [
+    ('organisation', {'organisation': 'org1'}, 'org1'),
+    ('organisation', {'organisation': {'$ref': ORG_REF}}, '1'),
+    ('organisation', {'organisation': {'$ref': ORG_REF + '/'}}, '1'),
+    ('organisation', {'organisation': {'pid': '1'}}, {'pid': '1'}),
+    ('organisation', {}, None),
+    ('loan.item.pid', {'loan': {'item': {'pid': 'i1'}}}, 'i1'),
+    ('loan.item.pid', {'loan': {'item': None}}, None),
+    ('loan.item.pid', {'loan': ['item']}, None),
+    ('loan.item.pid', {'loan': 'text'}, None),
+    ('loan', {'loan': 0}, 0)
+])
+def test_key_from_path(path, record, expected):
+    """The value of the path is returned, references are resolved."""
+    assert key_from_path(path)(record) == expected
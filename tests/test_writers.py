@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# RERO ILS
+# Copyright (C) 2022 RERO
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Output writers tests."""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from rero_ils_tools.writers import AsyncJsonWriter, BufferedJsonWriter, \
+    PartitionedJsonWriter
+
+RECORDS = [{'pid': str(pid), 'title': f'é {pid}'} for pid in range(5)]
+
+
+def test_buffered_json_writer(tmp_path):
+    """Records are written as a JSON array by blocks."""
+    filename = tmp_path / 'records.json'
+    with BufferedJsonWriter(filename, buffer_size=2) as writer:
+        for record in RECORDS:
+            writer.write(record)
+    assert json.loads(filename.read_text()) == RECORDS
+    assert writer.count == 5
+
+
+def test_partitioned_json_writer(tmp_path):
+    """Records are dispatched to one file per key."""
+    pattern = str(tmp_path / 'records_{key}.json')
+    with PartitionedJsonWriter(
+            pattern, lambda record: record.get('org'),
+            buffer_size=1) as writer:
+        assert writer.write({'pid': '1', 'org': 'a'}) == 'a'
+        writer.write({'pid': '2', 'org': 'b'})
+        writer.write({'pid': '3', 'org': 'a'})
+        writer.write({'pid': '4'})
+        # the files are created by the first record of their key
+        assert sorted(os.listdir(tmp_path)) == [
+            'records_None.json', 'records_a.json', 'records_b.json']
+    assert writer.counts() == {'a': 2, 'b': 1, None: 1}
+    assert json.loads((tmp_path / 'records_a.json').read_text()) == [
+        {'pid': '1', 'org': 'a'}, {'pid': '3', 'org': 'a'}]
+    assert json.loads((tmp_path / 'records_b.json').read_text()) == [
+        {'pid': '2', 'org': 'b'}]
+    assert json.loads((tmp_path / 'records_None.json').read_text()) == [
+        {'pid': '4'}]
+    # closing again does not alter the outputs
+    writer.close()
+    assert json.loads((tmp_path / 'records_b.json').read_text()) == [
+        {'pid': '2', 'org': 'b'}]
+
+
+def test_partitioned_json_writer_empty(tmp_path):
+    """No file is created without records."""
+    with PartitionedJsonWriter(
+            str(tmp_path / 'records_{key}.json'), lambda record: 1) as writer:
+        pass
+    assert writer.counts() == {}
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize('writer_class', [BufferedJsonWriter,
+                                          AsyncJsonWriter])
+def test_empty_output(tmp_path, writer_class):
+    """An output without record is an empty array."""
+    filename = tmp_path / 'records.json'
+    writer_class(filename).close()
+    assert json.loads(filename.read_text()) == []
+
+
+def test_async_json_writer(tmp_path):
+    """The output is the output of the buffered writer."""
+    async_file = tmp_path / 'async.json'
+    buffered_file = tmp_path / 'buffered.json'
+    with AsyncJsonWriter(async_file) as writer, \
+            BufferedJsonWriter(buffered_file) as buffered:
+        for record in RECORDS:
+            writer.write(record)
+            buffered.write(record)
+    assert writer.count == 5
+    assert async_file.read_text() == buffered_file.read_text()
+
+
+def test_async_json_writer_snapshot(tmp_path):
+    """Records changed after their write are written as they were."""
+    filename = tmp_path / 'records.json'
+    record = {'pid': '1', 'notes': ['note']}
+    with AsyncJsonWriter(filename, queue_size=1) as writer:
+        writer.write(record)
+        record['notes'].append('changed')
+        del record['pid']
+    assert json.loads(filename.read_text()) == [
+        {'pid': '1', 'notes': ['note']}]
+
+
+def test_async_json_writer_sync(tmp_path):
+    """Synced records are in the file before the writer is closed."""
+    filename = tmp_path / 'records.json'
+    writer = AsyncJsonWriter(filename)
+    for record in RECORDS[:3]:
+        writer.write(record)
+    writer.sync(wait=True)
+    # the array is not closed yet
+    assert json.loads(filename.read_text() + '\n]') == RECORDS[:3]
+    writer.write(RECORDS[3])
+    writer.close()
+    writer.close()
+    assert json.loads(filename.read_text()) == RECORDS[:4]
+
+
+def test_async_json_writer_error(tmp_path):
+    """An error of the background thread is raised to the caller."""
+    writer = AsyncJsonWriter(tmp_path / 'missing' / 'records.json')
+    with pytest.raises(FileNotFoundError):
+        writer.sync(wait=True)
+    with pytest.raises(FileNotFoundError):
+        writer.write(RECORDS[0])
+    with pytest.raises(FileNotFoundError):
+        writer.close()
+
+
+def test_async_json_writer_atexit(tmp_path):
+    """A writer which is not closed is completed at exit."""
+    filename = tmp_path / 'records.json'
+    script = (
+        'import sys\n'
+        'from rero_ils_tools.writers import AsyncJsonWriter\n'
+        f'writer = AsyncJsonWriter({str(filename)!r})\n'
+        'for pid in range(1000):\n'
+        '    writer.write({"pid": pid})\n'
+        'sys.exit(0)\n')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, '-c', script], check=True, cwd=root)
+    assert json.loads(filename.read_text()) == [
+        {'pid': pid} for pid in range(1000)]